@@ -0,0 +1,297 @@
+"""
+Benchmarks for grafting tree sequences at scale.
+
+Synthetic split tree sequences are simulated with msprime (no SLiM binary
+needed): a root population splits into ``num_branches`` populations ``T``
+generations ago, and each branch keeps the nodes before the split plus
+its own samples. Nodes carry SLiM-like metadata and the tree sequences
+SLiM-like provenances, so that ``find_split_time`` and ``match_nodes``
+run as they would on SLiM output.
+
+Each function is timed and its peak memory measured in a forked
+process, and the phases of those that take a ``graft.Profiler`` are
+reported as well (as ``<function>/<phase>``, with their time and change
+in resident memory). The results are written as JSON lines, e.g.::
+
+    python benchmarks/benchmark_graft.py --samples 100 1000 \\
+        --sequence-length 1e6 1e7 --output results.jsonl
+
+Passing the results of an earlier run as ``--baseline`` reports phases
+that got slower by more than ``--tolerance`` times, and exits with an
+error if there are any.
+"""
+import argparse
+import functools
+import itertools
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+import msprime
+import numpy as np
+import tskit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import graft  # noqa: E402
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "tests"))
+import simulations  # noqa: E402
+
+
+def simulate_branches(num_samples, sequence_length, num_branches, T=100,
+                      N=1000, recombination_rate=1e-8, mutation_rate=1e-8,
+                      seed=1):
+    """
+    Returns ``num_branches`` SLiM-like tree sequences sharing their
+    history up to ``T`` generations ago, each with ``num_samples``
+    haploid samples, and the map from the nodes of the others to those
+    of the first.
+    """
+    ts = simulations.simulate_split(
+        num_samples, num_branches, T, N, sequence_length,
+        recombination_rate, mutation_rate, ploidy=1, seed=seed)
+    return simulations.slim_like_branches(ts, T, num_branches, gens=1000,
+                                          filter_populations=False)
+
+
+def _rss():
+    # resident memory of this process, in bytes (Linux only)
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+def _reset_peak_rss():
+    # resets the peak resident memory of this process to its current
+    # resident memory, returning whether it could (Linux only); this is
+    # only done in the forked process running a phase
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        return False
+    return True
+
+
+def _peak_rss():
+    # peak resident memory of this process since it was last reset, in
+    # bytes (Linux only)
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    # in kilobytes
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def _run_phase(conn, func, args, profile):
+    # the peak is that of the phase alone if the high-water mark of the
+    # forked process can be reset
+    profiler = graft.Profiler() if profile else None
+    kwargs = {} if profiler is None else {"profiler": profiler}
+    reset = _reset_peak_rss()
+    start_rss = _rss()
+    start = time.perf_counter()
+    try:
+        func(*args, **kwargs)
+    except Exception as e:
+        conn.send(e)
+        conn.close()
+        return
+    seconds = time.perf_counter() - start
+    peak = None
+    if reset and start_rss is not None:
+        peak = max(0, _peak_rss() - start_rss)
+    conn.send((seconds, peak, [] if profiler is None else profiler.report()))
+    conn.close()
+
+
+def measure(func, *args, profile=False):
+    """
+    Returns the time taken by ``func(*args)`` and the increase in peak
+    resident memory while it ran, in a forked process, so that the
+    memory used by tskit's C library is counted and each phase starts
+    afresh. If ``profile`` is True, ``func`` is passed a
+    ``graft.Profiler``, whose report is returned as well.
+    """
+    context = multiprocessing.get_context("fork")
+    parent_conn, child_conn = context.Pipe()
+    process = context.Process(target=_run_phase,
+                              args=(child_conn, func, args, profile))
+    process.start()
+    result = parent_conn.recv()
+    process.join()
+    if isinstance(result, Exception):
+        name = getattr(func, "__name__", repr(func))
+        raise RuntimeError(f"Benchmark of {name} failed.") from result
+    return result
+
+
+def _graft_then_simplify(ts1, ts2, node_map21, simplify_to):
+    tsg, (node_map2new, _, _) = graft.graft(ts1, ts2, node_map21)
+    samples1, samples2 = simplify_to
+    samples = np.concatenate([samples1, node_map2new.array[samples2]])
+    tsg.simplify(np.unique(samples), filter_populations=False)
+
+
+def _graft_to_file(path1, path2, node_map21):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        graft.graft_to_file(path1, path2, os.path.join(tmpdir, "out.trees"),
+                            node_map21)
+
+
+def phases(branches, node_map21, tmpdir):
+    """
+    Yields the name, function and arguments of each phase benchmarked
+    for the given branches, and whether the function is profiled.
+    """
+    ts1, ts2 = branches[0], branches[1]
+    T1, T2 = graft.find_split_time(ts1, ts2)
+    node_maps = [graft.IdMap.from_dict(node_map21, ts.num_nodes)
+                 for ts in branches[1:]]
+    node_map21 = node_maps[0]
+    yield "find_split_time", graft.find_split_time, (ts1, ts2), False
+    yield "match_nodes", graft.match_nodes, (ts1, ts2, T2), True
+    yield "match_prefix", graft.match_prefix, (ts1, ts2, T2), True
+    yield "add_time", graft.add_time, (ts2, 10), False
+    tables1, tables2 = ts1.dump_tables(), ts2.dump_tables()
+    yield ("validate_graft", graft.validate_graft,
+           (tables1, tables2, node_map21), False)
+    # the phases of graft (copying the tables, checking the shared
+    # history, grafting rows and sorting them) are profiled, with each
+    # mode of the shared history check
+    for mode in ["full", "fast", "off"]:
+        yield (f"graft_check_{mode}",
+               functools.partial(graft.graft, check_shared=mode),
+               (ts1, ts2, node_map21), True)
+    # grafting and simplifying to the present-day samples, fused and not
+    simplify_to = (ts1.samples(time=0), ts2.samples(time=0))
+    yield "graft_then_simplify", _graft_then_simplify, (
+        ts1, ts2, node_map21, simplify_to), False
+    yield "graft_and_simplify", graft.graft_and_simplify, (
+        ts1, ts2, node_map21, *simplify_to), True
+    path1 = os.path.join(tmpdir, "ts1.trees")
+    path2 = os.path.join(tmpdir, "ts2.trees")
+    ts1.dump(path1)
+    ts2.dump(path2)
+    yield "graft_to_file", _graft_to_file, (path1, path2, node_map21), False
+    if len(branches) > 2:
+        yield ("graft_many", graft.graft_many,
+               (ts1, branches[1:], node_maps), False)
+
+
+def run(args):
+    environment = {
+        "tskit": tskit.__version__,
+        "msprime": msprime.__version__,
+        "numpy": np.__version__,
+        "python": sys.version.split()[0],
+    }
+    for num_samples, sequence_length, num_branches in itertools.product(
+            args.samples, args.sequence_length, args.branches):
+        branches, node_map21 = simulate_branches(
+            num_samples, sequence_length, num_branches,
+            mutation_rate=args.mutation_rate, seed=args.seed)
+        ts1 = branches[0]
+        case = {
+            "num_samples": num_samples,
+            "sequence_length": sequence_length,
+            "num_branches": num_branches,
+            "num_nodes": ts1.num_nodes,
+            "num_edges": ts1.num_edges,
+            "num_mutations": ts1.num_mutations,
+        }
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for phase, func, func_args, profile in phases(
+                    branches, node_map21, tmpdir):
+                for repeat in range(args.repeats):
+                    seconds, peak_memory, report = measure(
+                        func, *func_args, profile=profile)
+                    yield dict(case, phase=phase, repeat=repeat,
+                               seconds=seconds, peak_memory=peak_memory,
+                               environment=environment)
+                    for sub in report:
+                        yield dict(case, phase=f"{phase}/{sub['name']}",
+                                   repeat=repeat, seconds=sub["seconds"],
+                                   rss_delta=sub["rss_delta"],
+                                   environment=environment)
+
+
+def _key(result):
+    return (result["phase"], result["num_samples"],
+            result["sequence_length"], result["num_branches"])
+
+
+def compare(results, baseline, tolerance):
+    """
+    Returns a description of each phase whose fastest time in
+    ``results`` is over ``tolerance`` times that in ``baseline``.
+    """
+    def fastest(rows):
+        times = {}
+        for row in rows:
+            key = _key(row)
+            times[key] = min(times.get(key, np.inf), row["seconds"])
+        return times
+
+    times, baseline_times = fastest(results), fastest(baseline)
+    slower = []
+    for key, seconds in sorted(times.items()):
+        if key in baseline_times and seconds > tolerance * baseline_times[
+                key]:
+            slower.append(
+                f"{key[0]} (samples={key[1]}, length={key[2]}, "
+                f"branches={key[3]}): {seconds:.4g}s against "
+                f"{baseline_times[key]:.4g}s")
+    return slower
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--samples", type=int, nargs="+",
+                        default=[100, 1000],
+                        help="Number of samples in each branch")
+    parser.add_argument("--sequence-length", type=float, nargs="+",
+                        default=[1e7], help="Sequence lengths")
+    parser.add_argument("--branches", type=int, nargs="+", default=[2, 4],
+                        help="Numbers of branches (at least 2)")
+    parser.add_argument("--mutation-rate", type=float, default=1e-8)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default="-",
+                        help="File to write the JSON lines to "
+                        "(default: standard output)")
+    parser.add_argument("--baseline",
+                        help="JSON lines from an earlier run to compare to")
+    parser.add_argument("--tolerance", type=float, default=1.5)
+    args = parser.parse_args(argv)
+    if min(args.branches) < 2:
+        parser.error("Need at least two branches.")
+    out = sys.stdout if args.output == "-" else open(args.output, "w")
+    results = []
+    try:
+        for result in run(args):
+            results.append(result)
+            print(json.dumps(result), file=out, flush=True)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = [json.loads(line) for line in f if line.strip()]
+        slower = compare(results, baseline, args.tolerance)
+        for line in slower:
+            print("Slower:", line, file=sys.stderr)
+        if len(slower) > 0:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
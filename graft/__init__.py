@@ -1,97 +1,928 @@
+import collections
+import collections.abc
+import concurrent.futures
+import contextlib
+import hashlib
+import itertools
 import numpy as np
 import tskit
 import tskit.provenance as tsp
 import json
+import os
+import struct
+import tempfile
+import time
+
+
+class IdMap(collections.abc.MutableMapping):
+    """
+    A mapping between integer IDs backed by a dense NumPy array, where
+    ``array[k]`` is the ID that ``k`` maps to or ``tskit.NULL`` if ``k``
+    is unmapped. It behaves as a dictionary holding only the mapped IDs,
+    so it can be used wherever a ``{old_id: new_id}`` dict was expected.
+    """
+
+    def __init__(self, array):
+        self.array = np.asarray(array, dtype=np.int32)
+
+    @classmethod
+    def from_dict(cls, id_map, size=None):
+        """
+        Returns the IdMap equivalent to the dictionary ``id_map``, with
+        keys in ``range(size)`` (by default, up to the largest key).
+        """
+        keys = np.fromiter(id_map.keys(), dtype=np.int64, count=len(id_map))
+        values = np.fromiter(id_map.values(), dtype=np.int32,
+                             count=len(id_map))
+        if size is None:
+            size = keys.max() + 1 if len(keys) > 0 else 0
+        if np.any(keys < 0) or np.any(keys >= size):
+            raise ValueError(f"Map keys must be IDs in [0, {size}).")
+        array = np.full(size, tskit.NULL, dtype=np.int32)
+        array[keys] = values
+        return cls(array)
+
+    def keys_array(self):
+        """
+        Returns the mapped IDs (in increasing order) as a NumPy array.
+        """
+        return np.flatnonzero(self.array != tskit.NULL).astype(np.int32)
+
+    def values_array(self):
+        """
+        Returns the IDs the mapped IDs map to, in the order of
+        :meth:`keys_array`.
+        """
+        return self.array[self.array != tskit.NULL]
+
+    def _index(self, key):
+        if isinstance(key, (int, np.integer)) and not isinstance(
+                key, bool) and 0 <= key < len(self.array):
+            return int(key)
+        raise KeyError(key)
+
+    def __getitem__(self, key):
+        value = self.array[self._index(key)]
+        if value == tskit.NULL:
+            raise KeyError(key)
+        return int(value)
+
+    def __setitem__(self, key, value):
+        self.array[self._index(key)] = value
+
+    def __delitem__(self, key):
+        self[key]
+        self.array[self._index(key)] = tskit.NULL
+
+    def __contains__(self, key):
+        try:
+            return self.array[self._index(key)] != tskit.NULL
+        except KeyError:
+            return False
+
+    def __iter__(self):
+        return iter(self.keys_array().tolist())
+
+    def __len__(self):
+        return int(np.count_nonzero(self.array != tskit.NULL))
+
+    def __repr__(self):
+        return f"IdMap(size={len(self.array)}, mapped={len(self)})"
+
+    def copy(self):
+        return IdMap(self.array.copy())
+
+    def ranges(self):
+        """
+        Returns the runs of consecutive mapped IDs that map to consecutive
+        IDs, as an array with rows (first key, first value, length).
+        """
+        keys = self.keys_array().astype(np.int64)
+        values = self.values_array().astype(np.int64)
+        starts = np.flatnonzero(np.concatenate([
+            [True], (np.diff(keys) != 1) | (np.diff(values) != 1)]))
+        if len(keys) == 0:
+            starts = starts[:0]
+        lengths = np.diff(np.append(starts, len(keys)))
+        return np.column_stack([keys[starts], values[starts], lengths])
+
+    @classmethod
+    def from_ranges(cls, ranges, size):
+        """
+        Returns the IdMap over ``range(size)`` with the given
+        :meth:`ranges`.
+        """
+        ranges = np.asarray(ranges, dtype=np.int64).reshape(-1, 3)
+        array = np.full(size, tskit.NULL, dtype=np.int32)
+        for key, value, length in ranges:
+            array[key:key + length] = np.arange(value, value + length)
+        return cls(array)
+
+    def digest(self):
+        """
+        Returns the SHA-256 hex digest of the mapped IDs and the IDs they
+        map to.
+        """
+        digest = hashlib.sha256()
+        digest.update(self.keys_array().astype("<i4").tobytes())
+        digest.update(self.values_array().astype("<i4").tobytes())
+        return digest.hexdigest()
+
+    def dump(self, path):
+        """
+        Writes the IdMap to ``path`` as a NumPy ``.npy`` file.
+        """
+        with open(path, "wb") as f:
+            np.save(f, self.array)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Returns the IdMap written to ``path`` by :meth:`dump`.
+        """
+        return cls(np.load(path))
+
+
+def _as_id_map(id_map, size):
+    """
+    Returns ``id_map`` (an IdMap or a dictionary) as an IdMap over
+    ``range(size)``.
+    """
+    if isinstance(id_map, IdMap):
+        if len(id_map.array) != size:
+            raise ValueError(
+                f"Map has size {len(id_map.array)}, expected {size}.")
+        return id_map
+    return IdMap.from_dict(id_map, size)
+
+
+def _loose_id_map(id_map):
+    # an IdMap, or a dictionary as an IdMap just large enough for its keys
+    if isinstance(id_map, IdMap):
+        return id_map
+    return IdMap.from_dict(id_map, max(id_map, default=-1) + 1)
+
+
+def _ragged_take(data, offset, rows):
+    """
+    Returns the ``(data, offset)`` columns of a ragged column restricted
+    to the given ``rows`` (in that order), without looping over rows.
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    offset = np.asarray(offset)
+    starts = offset[:-1][rows].astype(np.int64)
+    lengths = offset[1:][rows].astype(np.int64) - starts
+    new_offset = np.zeros(len(rows) + 1, dtype=offset.dtype)
+    np.cumsum(lengths, out=new_offset[1:])
+    index = np.repeat(starts - new_offset[:-1].astype(np.int64), lengths)
+    index += np.arange(len(index), dtype=np.int64)
+    return data[index], new_offset
+
+
+def _first_seen(values):
+    """
+    Returns the unique values in ``values`` in order of first appearance.
+    """
+    uniq, first = np.unique(values, return_index=True)
+    return uniq[np.argsort(first, kind="stable")]
+
+
+Phase = collections.namedtuple("Phase", ["name", "seconds", "rss_delta",
+                                         "rows"])
+
+
+class Profiler:
+    """
+    Records a :class:`Phase` for each phase of :func:`find_split_time`,
+    :func:`match_nodes` and :func:`graft` when passed to them as
+    ``profiler``: its name, wall time in seconds, the change in the
+    resident memory of the process over the phase (in bytes, sampled as
+    it starts and ends, and None where it can't be read), and the numbers
+    of rows it worked on, by table. ``callback``, if given, is called
+    with each phase as it ends.
+    """
+
+    def __init__(self, callback=None):
+        self.phases = []
+        self.callback = callback
+
+    @contextlib.contextmanager
+    def phase(self, name, **rows):
+        start_rss = _rss()
+        start = time.perf_counter()
+        yield
+        seconds = time.perf_counter() - start
+        rss_delta = None if start_rss is None else _rss() - start_rss
+        phase = Phase(name, seconds, rss_delta, rows)
+        self.phases.append(phase)
+        if self.callback is not None:
+            self.callback(phase)
+
+    def report(self):
+        """
+        Returns the phases recorded, in order, as a list of dictionaries.
+        """
+        return [phase._asdict() for phase in self.phases]
+
+    def __str__(self):
+        lines = []
+        for phase in self.phases:
+            rows = ", ".join(f"{k}={v}" for k, v in phase.rows.items())
+            rss_delta = "-" if phase.rss_delta is None else (
+                f"delta {phase.rss_delta / 2 ** 20:+.1f}MiB")
+            lines.append(f"{phase.name:<20} {phase.seconds:>10.4f}s "
+                         f"{rss_delta:>18} {rows}")
+        return "\n".join(lines)
+
+
+def _rss():
+    # resident memory of this process, in bytes (Linux only)
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+_NO_PHASE = contextlib.nullcontext()
+
+
+def _phase(profiler, name, **rows):
+    """
+    Returns the context in which to run the phase ``name`` of an
+    operation, which is timed if ``profiler`` is not None.
+    """
+    if profiler is None:
+        return _NO_PHASE
+    return profiler.phase(name, **rows)
 
 
 def get_slim_gens(ts):
     return np.array([p.slim_generation for p in ts.slim_provenances])
 
 
-def find_split_time(ts1, ts2):
+def find_split_time(ts1, ts2, profiler=None):
     """
     Given two SLiM tree sequences with shared history, this
     function returns the split times (in time ago) for each tree.
+    Only their provenance tables are read, so they can also be
+    TableCollections. Its phases are recorded by the :class:`Profiler`
+    ``profiler``, if given.
+    """
+    with _phase(profiler, "find_split_time",
+                provenances=_num_provenances(ts1) + _num_provenances(ts2)):
+        return _find_split_time(ts1, ts2)
+
+
+def _num_provenances(ts):
+    if isinstance(ts, tskit.TreeSequence):
+        return ts.num_provenances
+    return ts.provenances.num_rows
+
+
+def _find_split_time(ts1, ts2):
+    provenances1 = _provenance_table(ts1)
+    provenances2 = _provenance_table(ts2)
+    num_shared = _shared_provenances(provenances1, provenances2)
+    return _split_times(
+        _last_slim_generation(provenances1, num_shared),
+        _last_slim_generation(provenances1),
+        _last_slim_generation(provenances2))
+
+
+def _provenance_table(ts):
+    """
+    Returns the provenance table of ``ts`` (a tree sequence, or a
+    TableCollection or other table-like object), without copying the
+    other tables of a tree sequence.
+    """
+    if not isinstance(ts, tskit.TreeSequence):
+        return ts.provenances
+    provenances = tskit.ProvenanceTable()
+    if ts.num_provenances > 0:
+        timestamps, records = zip(*[(p.timestamp, p.record)
+                                    for p in ts.provenances()])
+        timestamp, timestamp_offset = _pack_strings(timestamps)
+        record, record_offset = _pack_strings(records)
+        provenances.set_columns(
+            timestamp=timestamp, timestamp_offset=timestamp_offset,
+            record=record, record_offset=record_offset)
+    return provenances
+
+
+def _pack_strings(strings):
+    # tskit.pack_strings, joining the strings in one go
+    encoded = [string.encode() for string in strings]
+    offset = np.zeros(len(encoded) + 1, dtype=np.uint64)
+    np.cumsum([len(data) for data in encoded], out=offset[1:])
+    return np.frombuffer(b"".join(encoded), dtype=np.int8), offset
+
+
+def _shared_provenances(provenances1, provenances2):
+    """
+    Returns the number of rows at the start of two provenance tables
+    that are the same, comparing their columns in bulk.
+    """
+    n = min(provenances1.num_rows, provenances2.num_rows)
+    columns = [("timestamp", "timestamp_offset"), ("record", "record_offset")]
+    # the rows before the first whose timestamp or record lengths differ
+    # are at the same offsets in both tables
+    differ = np.zeros(n, dtype=bool)
+    for _, name in columns:
+        offset1 = getattr(provenances1, name)[:n + 1].astype(np.int64)
+        offset2 = getattr(provenances2, name)[:n + 1].astype(np.int64)
+        differ |= np.diff(offset1) != np.diff(offset2)
+    differ = np.flatnonzero(differ)
+    n = differ[0] if len(differ) > 0 else n
+    # so their bytes can be compared directly
+    for data, name in columns:
+        offset = getattr(provenances1, name)[:n + 1]
+        end = int(offset[-1])
+        differ = np.flatnonzero(getattr(provenances1, data)[:end]
+                                != getattr(provenances2, data)[:end])
+        if len(differ) > 0:
+            n = min(n, np.searchsorted(offset, differ[0], side="right") - 1)
+    return int(n)
+
+
+def _slim_generation(record):
+    """
+    Returns the SLiM generation in the provenance ``record`` (as pyslim
+    reads it, in the current or the older format, or the tick of SLiM 4
+    records), or None if it is not a SLiM record or has neither.
+    """
+    record = json.loads(record)
+    if "software" in record:
+        if record["software"]["name"] != "SLiM":
+            return None
+        slim = record.get("slim", {})
+        return slim.get("tick", slim.get("generation"))
+    if record.get("program") != "SLiM":
+        return None
+    return record["generation"]
+
+
+def _last_slim_generation(provenances, end=None):
+    """
+    Returns the SLiM generation of the last SLiM record in the provenance
+    table ``provenances`` before row ``end`` (by default, in the whole
+    table), or None if there is none. Only the records after it are
+    parsed.
+    """
+    record, offset = provenances.record, provenances.record_offset
+    end = provenances.num_rows if end is None else end
+    for j in range(end - 1, -1, -1):
+        generation = _slim_generation(
+            bytes(record[offset[j]:offset[j + 1]]))
+        if generation is not None:
+            return generation
+    return None
+
+
+def _split_times(last_shared_gen, last_gen1, last_gen2):
+    """
+    Returns the split times of two tree sequences whose last shared SLiM
+    provenance record is at generation ``last_shared_gen``, and whose
+    last SLiM records are at ``last_gen1`` and ``last_gen2``.
     """
-    slim_gens1 = get_slim_gens(ts1)
-    slim_gens2 = get_slim_gens(ts2)
-    # counting SLiM prov before chains diff
-    j = 0
-    # finding the first diff between provenance chains
-    for p1, p2 in zip(ts1.provenances(), ts2.provenances()):
-        if p1 != p2:
-            break
-        record = json.loads(p1.record)
-        if record["software"]["name"] == "SLiM":
-            j += 1
-    if j == 0:
+    if last_shared_gen is None:
         raise ValueError("No shared SLiM provenance entries.")
-    last_slim_gen = ts1.slim_provenances[j - 1].slim_generation
-    T1 = abs(last_slim_gen - slim_gens1[-1])
-    T2 = abs(last_slim_gen - slim_gens2[-1])
+    T1 = abs(last_shared_gen - last_gen1)
+    T2 = abs(last_shared_gen - last_gen2)
     return T1, T2
 
 
-def match_nodes(ts1, ts2, T2=0):
+def _slim_id_view(nodes):
     """
-    Given two SLiM tree sequences, returns a dictionary relating
-    the id in ts2 (key) to id in ts1 (item) for  node IDs in the
-    two tree sequences that refer to the same node. If split time
-    in ts2 (T2) is given, then only nodes before the split are
-    considered. Note the only check of equivalency is the slim_id
-    of the nodes.
+    Returns the slim_ids of the rows of a node table as a view into its raw
+    metadata column, or None if the metadata is not the fixed-width SLiM
+    node layout (an int64 slim_id followed by fixed-size fields).
+    """
+    width = 10
+    schema = nodes.metadata_schema.schema
+    if schema is not None:
+        if schema.get("codec") != "struct":
+            return None
+        props = sorted(schema["properties"].items(),
+                       key=lambda x: x[1].get("index", 0))
+        if len(props) == 0 or props[0][0] != "slim_id" or (
+                props[0][1].get("binaryFormat") != "q"):
+            return None
+        try:
+            width = struct.calcsize(
+                "<" + "".join(p["binaryFormat"] for _, p in props))
+        except (KeyError, struct.error):
+            return None
+    num_rows = nodes.num_rows
+    offset = nodes.metadata_offset
+    if len(nodes.metadata) != width * num_rows or not np.array_equal(
+            offset, np.arange(num_rows + 1, dtype=offset.dtype) * width):
+        return None
+    dtype = np.dtype([("slim_id", "<i8"), ("rest", f"V{width - 8}")])
+    return nodes.metadata.view(dtype)["slim_id"]
+
+
+def get_slim_ids(ts):
+    """
+    Returns the slim_id of every node in the tree sequence, read
+    straight from the metadata column when it has the fixed-width
+    SLiM layout and decoded node by node otherwise. ``ts`` can also be
+    a TableCollection.
+    """
+    return _slim_ids(_tables(ts).nodes)
+
+
+def _slim_ids(nodes, start=0):
+    """
+    Returns the slim_ids of the rows of the node table ``nodes`` from
+    ``start`` on (see :func:`get_slim_ids`).
+    """
+    slim_ids = _slim_id_view(nodes)
+    if slim_ids is not None:
+        return slim_ids[start:]
+    try:
+        return np.array([
+            n.metadata["slim_id"] if isinstance(n.metadata, dict)
+            else n.metadata.slim_id
+            for n in itertools.islice(nodes, start, None)], dtype=np.int64)
+    except (AttributeError, KeyError, TypeError):
+        raise ValueError("Nodes have no slim_id metadata.")
+
+
+def _slim_id_index(ts):
+    """
+    Returns the slim_ids of the nodes of ``ts`` and the order that sorts
+    them, which is all :func:`match_nodes` needs to know about ts1.
+    """
+    slim_ids = get_slim_ids(ts)
+    return slim_ids, np.argsort(slim_ids)
+
+
+def _match_slim_ids(index1, slim_ids2, times2, T2=0):
+    """
+    Returns the IdMap from nodes with ``slim_ids2`` and ``times2`` to
+    the nodes in ``index1`` (as returned by :func:`_slim_id_index`).
     """
-    node_map21 = {}
-    slim_ids1 = np.array([n.metadata.slim_id for n in ts1.nodes()])
-    slim_ids2 = np.array([n.metadata.slim_id for n in ts2.nodes()])
-    times = np.array([n.time for n in ts2.nodes()])
-    sorted_ids1 = np.argsort(slim_ids1)
+    slim_ids1, sorted_ids1 = index1
     matches = np.searchsorted(
         slim_ids1,
         slim_ids2,
         side='left',
         sorter=sorted_ids1)
-    is_2in1 = np.isin(slim_ids2, slim_ids1)
-    node_map21 = {a: sorted_ids1[b] for a, b in enumerate(
-        matches) if times[a] >= T2 and is_2in1[a]}
+    # a node of ts2 is in ts1 if the slim_id found by the search matches
+    is_2in1 = np.zeros(len(slim_ids2), dtype=bool)
+    if len(slim_ids1) > 0:
+        found = sorted_ids1[np.minimum(matches, len(slim_ids1) - 1)]
+        is_2in1 = slim_ids1[found] == slim_ids2
+    keep = (times2 >= T2) & is_2in1
+    node_map21 = IdMap(np.full(len(slim_ids2), tskit.NULL, dtype=np.int32))
+    node_map21.array[keep] = sorted_ids1[matches[keep]]
     return node_map21
 
 
+def match_nodes(ts1, ts2, T2=0, profiler=None):
+    """
+    Given two SLiM tree sequences, returns an IdMap relating
+    the id in ts2 (key) to id in ts1 (item) for  node IDs in the
+    two tree sequences that refer to the same node. If split time
+    in ts2 (T2) is given, then only nodes before the split are
+    considered. Note the only check of equivalency is the slim_id
+    of the nodes. Its phases are recorded by the :class:`Profiler`
+    ``profiler``, if given.
+    """
+    with _phase(profiler, "index_slim_ids", nodes=ts1.num_nodes):
+        index1 = _slim_id_index(ts1)
+    with _phase(profiler, "get_slim_ids", nodes=ts2.num_nodes):
+        tables2 = _tables(ts2)
+        slim_ids2 = get_slim_ids(tables2)
+    with _phase(profiler, "match_slim_ids", nodes=ts2.num_nodes):
+        return _match_slim_ids(index1, slim_ids2, tables2.nodes.time, T2)
+
+
+def match_prefix(ts1, ts2, T2=None, fallback=True, profiler=None):
+    """
+    Returns an IdMap relating nodes in ts2 to the same nodes in ts1, as
+    :func:`match_nodes` does, for tree sequences whose node tables start
+    with the same rows, as do branches of a common root: the longest
+    common prefix of the two node tables (identical but for a constant
+    shift in time) is found by comparing their columns block by block
+    and is mapped as is, without reading any slim_ids. Only the nodes
+    of ts2 after the prefix are then matched by slim_id, if
+    ``fallback`` is True. As in :func:`match_nodes`, only nodes at least
+    as old as ``T2`` (the split time in ts2) are matched.
+    Rows after the split can be the same in both tables without being
+    the same nodes, which only their metadata can tell apart, so ``T2``
+    must be given if the prefix has nodes without metadata (as for tree
+    sequences not from SLiM, as long as all the nodes to match are in
+    the prefix). Otherwise it defaults to 0. Its phases are recorded by
+    the :class:`Profiler` ``profiler``, if given.
+    """
+    nodes1, nodes2 = _tables(ts1).nodes, _tables(ts2).nodes
+    with _phase(profiler, "common_prefix", nodes=nodes2.num_rows):
+        k = _common_prefix(nodes1, nodes2)
+        if T2 is None:
+            if np.any(np.diff(nodes2.metadata_offset[:k + 1]) == 0):
+                raise ValueError(
+                    "T2 is needed to match nodes without metadata.")
+            T2 = 0
+        times2 = nodes2.time
+        node_map21 = IdMap(np.full(nodes2.num_rows, tskit.NULL,
+                                   dtype=np.int32))
+        prefix = np.flatnonzero(times2[:k] >= T2).astype(np.int32)
+        node_map21.array[prefix] = prefix
+    if fallback and k < nodes1.num_rows and np.any(times2[k:] >= T2):
+        with _phase(profiler, "match_slim_ids",
+                    nodes=nodes2.num_rows - k):
+            slim_ids1 = _slim_ids(nodes1, k)
+            rest = _match_slim_ids(
+                (slim_ids1, np.argsort(slim_ids1)), _slim_ids(nodes2, k),
+                times2[k:], T2)
+            matched = rest.keys_array()
+            node_map21.array[matched + k] = rest.array[matched] + k
+    return node_map21
+
+
+# the number of node rows compared at a time by _common_prefix
+_PREFIX_BLOCK_SIZE = 2 ** 16
+
+
+def _common_prefix(nodes1, nodes2):
+    """
+    Returns the number of rows at the start of the node tables
+    ``nodes1`` and ``nodes2`` that are the same, but for a constant
+    difference in their times.
+    """
+    n = min(nodes1.num_rows, nodes2.num_rows)
+    if n == 0:
+        return 0
+    time1, time2 = nodes1.time, nodes2.time
+    dt = time1[0] - time2[0]
+    offset1, offset2 = nodes1.metadata_offset, nodes2.metadata_offset
+    metadata1, metadata2 = nodes1.metadata, nodes2.metadata
+    columns = [(nodes1.flags, nodes2.flags),
+               (nodes1.population, nodes2.population),
+               (nodes1.individual, nodes2.individual)]
+    for start in range(0, n, _PREFIX_BLOCK_SIZE):
+        stop = min(start + _PREFIX_BLOCK_SIZE, n)
+        same = time1[start:stop] - time2[start:stop] == dt
+        same &= np.diff(offset1[start:stop + 1]) == np.diff(
+            offset2[start:stop + 1])
+        for column1, column2 in columns:
+            same &= column1[start:stop] == column2[start:stop]
+        # the rows up to the first difference, and then their metadata
+        end = start + (np.argmin(same) if not np.all(same) else len(same))
+        bytes1 = metadata1[offset1[start]:offset1[end]]
+        bytes2 = metadata2[offset2[start]:offset2[end]]
+        differ = np.flatnonzero(bytes1 != bytes2)
+        if len(differ) > 0:
+            return start + int(np.searchsorted(
+                offset1[start:end + 1] - offset1[start], differ[0],
+                side="right")) - 1
+        if end < stop:
+            return end
+    return n
+
+
 def add_time(ts, dt):
     '''
     This function returns a tskit.TreeSequence in which `dt`
     has been added to the times in all nodes.
     '''
-    tables = ts.tables
-    nodes_dict = tables.nodes.asdict()
-    nodes_dict['time'] = nodes_dict['time'] + dt
-    tables.nodes.set_columns(**nodes_dict)
-    migrations_dict = tables.migrations.asdict()
-    migrations_dict['time'] = migrations_dict['time'] + dt
-    tables.migrations.set_columns(**migrations_dict)
+    tables = ts.dump_tables()
+    _shift_time(tables, dt)
     return tables.tree_sequence()
 
 
-def _check_shared_nodes(ts1, ts2, node_map21):
+def _shift_time(tables, dt):
+    """
+    Adds ``dt`` to the times of all nodes, migrations and mutations
+    (with known times) of the TableCollection ``tables``, in place.
+    Only the time columns are touched.
+    """
+    if dt == 0:
+        return
+    tables.nodes.time = tables.nodes.time + dt
+    if tables.migrations.num_rows > 0:
+        tables.migrations.time = tables.migrations.time + dt
+    time = tables.mutations.time
+    known = ~tskit.is_unknown_time(time)
+    if np.any(known):
+        time[known] += dt
+        tables.mutations.time = time
+
+
+def _tables(ts):
+    """
+    Returns the tables of the tree sequence ``ts``, or ``ts`` itself if
+    it already is a TableCollection (or another table-like object).
+    """
+    return ts.tables if isinstance(ts, tskit.TreeSequence) else ts
+
+
+def _remap(ids, id_map):
+    """
+    Returns ``ids`` mapped through the array ``id_map``, keeping NULLs.
+    """
+    # (an extra last entry maps NULL to NULL)
+    return np.append(id_map, tskit.NULL).astype(np.int32)[ids]
+
+
+def _shared_subgraph(tables, nodes):
+    """
+    Returns a new TableCollection holding only the ``nodes`` of
+    ``tables``, numbered in that order, with the edges above them (sorted
+    by child and left), the mutations on them (sorted by position and
+    node, each at a site of its own) and the populations and individuals
+    they refer to (in ID order). Sample flags and mutation parents are
+    left out. ``tables`` can be any object with table-like attributes
+    holding column arrays.
+    """
+    new_tables = tskit.TableCollection(tables.sequence_length)
+    node_table = tables.nodes
+    node_map = np.full(node_table.num_rows, tskit.NULL, dtype=np.int32)
+    node_map[nodes] = np.arange(len(nodes), dtype=np.int32)
+    # populations and individuals of the nodes
+    populations = tables.populations
+    pops = node_table.population[nodes]
+    pop_keep = np.unique(pops[pops != tskit.NULL])
+    pop_map = np.full(populations.num_rows, tskit.NULL, dtype=np.int32)
+    pop_map[pop_keep] = np.arange(len(pop_keep), dtype=np.int32)
+    metadata, metadata_offset = _ragged_take(
+        populations.metadata, populations.metadata_offset, pop_keep)
+    new_tables.populations.set_columns(
+        metadata=metadata, metadata_offset=metadata_offset)
+    individuals = tables.individuals
+    inds = node_table.individual[nodes]
+    ind_keep = np.unique(inds[inds != tskit.NULL])
+    ind_map = np.full(individuals.num_rows, tskit.NULL, dtype=np.int32)
+    ind_map[ind_keep] = np.arange(len(ind_keep), dtype=np.int32)
+    location, location_offset = _ragged_take(
+        individuals.location, individuals.location_offset, ind_keep)
+    parents, parents_offset = _ragged_take(
+        individuals.parents, individuals.parents_offset, ind_keep)
+    metadata, metadata_offset = _ragged_take(
+        individuals.metadata, individuals.metadata_offset, ind_keep)
+    new_tables.individuals.set_columns(
+        flags=individuals.flags[ind_keep],
+        location=location, location_offset=location_offset,
+        parents=_remap(parents, ind_map), parents_offset=parents_offset,
+        metadata=metadata, metadata_offset=metadata_offset)
+    metadata, metadata_offset = _ragged_take(
+        node_table.metadata, node_table.metadata_offset, nodes)
+    new_tables.nodes.set_columns(
+        flags=node_table.flags[nodes] & ~np.uint32(tskit.NODE_IS_SAMPLE),
+        time=node_table.time[nodes], population=_remap(pops, pop_map),
+        individual=_remap(inds, ind_map),
+        metadata=metadata, metadata_offset=metadata_offset)
+    # edges above the nodes (their parents, if not among the nodes,
+    # are NULL)
+    edges = tables.edges
+    child = node_map[edges.child]
+    keep = np.flatnonzero(child != tskit.NULL)
+    left, child = edges.left[keep], child[keep]
+    order = np.lexsort((left, child))
+    keep = keep[order]
+    new_tables.edges.set_columns(
+        left=left[order], right=edges.right[keep],
+        parent=node_map[edges.parent[keep]], child=child[order])
+    # mutations on the nodes, with their sites
+    mutations = tables.mutations
+    sites = tables.sites
+    node = node_map[mutations.node]
+    keep = np.flatnonzero(node != tskit.NULL)
+    site, node = mutations.site[keep], node[keep]
+    position = sites.position[site]
+    order = np.lexsort((node, position))
+    keep, site = keep[order], site[order]
+    ancestral_state, ancestral_state_offset = _ragged_take(
+        sites.ancestral_state, sites.ancestral_state_offset, site)
+    metadata, metadata_offset = _ragged_take(
+        sites.metadata, sites.metadata_offset, site)
+    new_tables.sites.set_columns(
+        position=position[order],
+        ancestral_state=ancestral_state,
+        ancestral_state_offset=ancestral_state_offset,
+        metadata=metadata, metadata_offset=metadata_offset)
+    derived_state, derived_state_offset = _ragged_take(
+        mutations.derived_state, mutations.derived_state_offset, keep)
+    metadata, metadata_offset = _ragged_take(
+        mutations.metadata, mutations.metadata_offset, keep)
+    new_tables.mutations.set_columns(
+        site=np.arange(len(keep), dtype=np.int32), node=node[order],
+        time=mutations.time[keep],
+        derived_state=derived_state,
+        derived_state_offset=derived_state_offset,
+        metadata=metadata, metadata_offset=metadata_offset)
+    for name in ["individuals", "populations", "nodes", "sites",
+                 "mutations"]:
+        getattr(new_tables, name).metadata_schema = getattr(
+            tables, name).metadata_schema
+    new_tables.metadata_schema = tables.metadata_schema
+    new_tables.metadata = tables.metadata
+    new_tables.time_units = tables.time_units
+    return new_tables
+
+
+def _column_mismatch(col1, col2):
+    """
+    Returns the first index at which the two arrays differ (comparing
+    raw values, so that NaNs are equal to themselves), or None.
+    """
+    n = min(len(col1), len(col2))
+    col1, col2 = np.asarray(col1[:n]), np.asarray(col2[:n])
+    if col1.dtype.kind == "f":
+        col1 = col1.view(f"u{col1.dtype.itemsize}")
+        col2 = col2.view(f"u{col2.dtype.itemsize}")
+    diff = np.flatnonzero(col1 != col2)
+    return diff[0] if len(diff) > 0 else None
+
+
+def _table_mismatch(table1, table2):
+    """
+    Returns the first row at which the two tables differ, or None.
+    """
+    num_rows = min(table1.num_rows, table2.num_rows)
+    first = num_rows if table1.num_rows != table2.num_rows else None
+    columns1, columns2 = table1.asdict(), table2.asdict()
+    for name, col1 in columns1.items():
+        col2 = columns2[name]
+        if name == "metadata_schema" or name.endswith("_offset"):
+            continue
+        if name + "_offset" in columns1:
+            off1, off2 = columns1[name + "_offset"], columns2[name + "_offset"]
+            # rows are the same up to the first differing length
+            # or the row holding the first differing byte
+            row = _column_mismatch(np.diff(off1), np.diff(off2))
+            byte = _column_mismatch(col1, col2)
+            if byte is not None:
+                byte_row = np.searchsorted(off1, byte, side="right") - 1
+                row = byte_row if row is None else min(row, byte_row)
+        else:
+            row = _column_mismatch(col1, col2)
+        if row is not None and row < num_rows:
+            first = row if first is None else min(first, row)
+    return first
+
+
+def _compare_tables(tables1, tables2):
+    """
+    Raises a ValueError describing the first record that differs
+    between the two table collections, ignoring provenances.
+    """
+    for name in ["populations", "individuals", "nodes", "edges",
+                 "sites", "mutations", "migrations"]:
+        table1, table2 = getattr(tables1, name), getattr(tables2, name)
+        row = _table_mismatch(table1, table2)
+        if row is not None:
+            row1 = table1[row] if row < table1.num_rows else None
+            row2 = table2[row] if row < table2.num_rows else None
+            raise ValueError(
+                f"Shared history differs in the {name} table at row "
+                f"{row}: {row1} in ts1 and {row2} in ts2.")
+    tables1 = tables1.copy()
+    tables2 = tables2.copy()
+    tables1.provenances.clear()
+    tables2.provenances.clear()
+    if tables1 != tables2:
+        raise ValueError("Shared history differs between ts1 and ts2.")
+
+
+def _check_shared_nodes(ts1, ts2, node_map21, mode="full",
+                        continued=False):
     '''
     Given two tree sequences with shared nodes as described in
     `node_map21`, test whether simplifying on those nodes gives
-    you the same tree sequences.
+    you the same tree sequences, raising a ValueError that describes
+    the first mismatching record if not.
+    With ``mode="full"`` both tree sequences are simplified as a whole.
+    With ``mode="fast"`` nothing is simplified: the shared nodes, the
+    edges above them and the mutations on them are sorted and compared
+    directly (see :func:`_shared_subgraph`), which is stricter than
+    simplifying (e.g. edges split differently do not match) but only
+    touches the rows of shared nodes. ``mode="off"`` skips the check.
+    If ``continued`` is True, ts1 is an earlier graft and ts2 a
+    continuation of the branch grafted then, whose populations are first
+    renumbered to those of ts1 through the populations of the shared
+    nodes (see :func:`_map_populations`). As graft does not keep the
+    ancestral states of the sites it adds, these are not compared then.
     '''
-    nodes2 = list(node_map21.keys())
-    nodes1 = list(node_map21.values())
-    ts1s = ts1.simplify(nodes1)
-    ts2s = ts2.simplify(nodes2)
-    tables1s = ts1s.tables
-    tables2s = ts2s.tables
-    tables1s.provenances.clear()
-    tables2s.provenances.clear()
-    assert tables1s == tables2s
+    if mode not in ("full", "fast", "off"):
+        raise ValueError(f"Unknown shared nodes check mode: {mode}")
+    if mode == "off":
+        return
+    if isinstance(ts2, tskit.TreeSequence):
+        node_map21 = _as_id_map(node_map21, ts2.num_nodes)
+    else:
+        node_map21 = _as_id_map(node_map21, ts2.nodes.num_rows)
+    nodes2 = node_map21.keys_array()
+    nodes1 = node_map21.values_array()
+    if len(nodes2) == 0:
+        return
+    if mode == "full":
+        tables1s = _simplified(ts1, nodes1)
+        tables2s = _simplified(ts2, nodes2)
+    else:
+        # the shared nodes in the order of their IDs in ts1
+        order = np.argsort(nodes1)
+        tables1s = _shared_subgraph(_tables(ts1), nodes1[order])
+        tables2s = _shared_subgraph(_tables(ts2), nodes2[order])
+    if continued:
+        _map_populations(tables1s, tables2s)
+        for tables in (tables1s, tables2s):
+            sites = tables.sites
+            sites.set_columns(
+                position=sites.position,
+                ancestral_state=np.zeros(0, dtype=np.int8),
+                ancestral_state_offset=np.zeros(sites.num_rows + 1,
+                                                dtype=np.uint32),
+                metadata=sites.metadata, metadata_offset=sites.metadata_offset)
+    _compare_tables(tables1s, tables2s)
+
+
+def _map_populations(tables1, tables2):
+    """
+    Renumbers, in place, the populations of the simplified ``tables2`` to
+    those of the simplified ``tables1``, as given by the populations of
+    their corresponding nodes. If these do not give a one-to-one map, the
+    tables are left as they are (and then compare as different).
+    """
+    pops1, pops2 = tables1.nodes.population, tables2.nodes.population
+    num_pops = tables2.populations.num_rows
+    if len(pops1) != len(pops2) or num_pops != tables1.populations.num_rows:
+        return
+    # (one extra slot so that NULL populations map to NULL)
+    pop_map = np.full(num_pops + 1, tskit.NULL, dtype=np.int32)
+    pop_map[pops2] = pops1
+    pop_map[tskit.NULL] = tskit.NULL
+    if np.any(pop_map[pops2] != pops1) or np.any(
+            pop_map[:num_pops] == tskit.NULL):
+        return
+    order = np.full(num_pops, tskit.NULL, dtype=np.int32)
+    order[pop_map[:num_pops]] = np.arange(num_pops, dtype=np.int32)
+    if np.any(order == tskit.NULL):
+        return
+    tables2.nodes.population = pop_map[pops2]
+    metadata, metadata_offset = _ragged_take(
+        tables2.populations.metadata, tables2.populations.metadata_offset,
+        order)
+    tables2.populations.set_columns(metadata=metadata,
+                                    metadata_offset=metadata_offset)
+
+
+def _simplified(ts, nodes):
+    """
+    Returns the tables of ``ts`` (a tree sequence or TableCollection)
+    simplified to ``nodes``, leaving ``ts`` unchanged.
+    """
+    if isinstance(ts, tskit.TableCollection):
+        tables = ts.copy()
+    elif ts.num_migrations > 0:
+        tables = ts.dump_tables()
+    else:
+        return ts.simplify(nodes).tables
+    # (simplify does not support migrations)
+    tables.migrations.clear()
+    tables.simplify(nodes)
+    return tables
+
+
+# node maps with more ranges than this are only summarised by their
+# digest in provenance records
+_MAX_PROV_RANGES = 1000
 
 
 def get_graft_prov_record(ts2, node_map21):
-    # TODO: this is NOT the definitive way it should be handled
-    ts2_prov_records = [prov.record for prov in ts2.tables.provenances]
+    """
+    Returns the JSON provenance record of grafting ts2 along the nodes in
+    ``node_map21`` (an IdMap or a dictionary). Its size is bounded: ts2's
+    provenance records are referenced by their number and digest, and the
+    node map is summarised by its size, digest and, if there are not too
+    many, its delta-encoded ranges (see :func:`get_graft_node_map`).
+    """
+    ts2_prov_records = [prov.record for prov in _tables(ts2).provenances]
+    if not isinstance(node_map21, IdMap):
+        node_map21 = IdMap.from_dict(node_map21)
+    return _graft_prov_record(ts2_prov_records, node_map21)
+
+
+def _graft_prov_record(ts2_prov_records, node_map21, node_map_key=None):
+    digest = hashlib.sha256()
+    for prov_record in ts2_prov_records:
+        digest.update(prov_record.encode() + b"\0")
+    ranges = node_map21.ranges()
+    node_map = {
+        "size": len(node_map21.array),
+        "num_mapped": len(node_map21),
+        "sha256": node_map21.digest(),
+        "num_ranges": len(ranges),
+    }
+    if len(ranges) <= _MAX_PROV_RANGES:
+        # each range starts relative to where the previous one ended
+        deltas = ranges.copy()
+        deltas[1:, :2] -= ranges[:-1, :2] + ranges[:-1, 2:]
+        node_map["ranges"] = deltas.ravel().tolist()
+    if node_map_key is not None:
+        node_map["kastore_key"] = node_map_key
     record = {
         "schema_version": "1.0.0",
         "software": {
@@ -100,137 +931,1186 @@ def get_graft_prov_record(ts2, node_map21):
         },
         "parameters": {
             "command": "graft",
-            "ts2_prov_records": ts2_prov_records,
-            "node_map21": node_map21
+            "ts2_provenances": {
+                "num_records": len(ts2_prov_records),
+                "sha256": digest.hexdigest(),
+            },
+            "node_map21": node_map,
         },
         "environment": tsp.get_environment()
     }
-    return str(record)
+    return json.dumps(record)
+
+
+def get_graft_node_map(prov_record, path=None):
+    """
+    Returns the IdMap ``node_map21`` used by the graft with the given
+    provenance record, from its ranges if they were recorded, or else
+    from the array stored in the tree sequence file ``path`` by
+    :func:`graft_to_file`. Raises a ValueError if neither is available.
+    """
+    node_map = json.loads(prov_record)["parameters"]["node_map21"]
+    if "ranges" in node_map:
+        ranges = np.array(node_map["ranges"], dtype=np.int64).reshape(-1, 3)
+        # undoing the delta encoding
+        previous_lengths = np.concatenate([[0], ranges[:-1, 2]])
+        ranges[:, :2] = np.cumsum(
+            ranges[:, :2] + previous_lengths[:, np.newaxis], axis=0)
+        node_map21 = IdMap.from_ranges(ranges, node_map["size"])
+    elif "kastore_key" in node_map and path is not None:
+        node_map21 = IdMap(np.array(_load_kastore(path)[
+            node_map["kastore_key"]]))
+    else:
+        raise ValueError("The node map of this graft was not recorded.")
+    if node_map21.digest() != node_map["sha256"]:
+        raise ValueError("The node map does not match its digest.")
+    return node_map21
+
+
+def _time_difference(time1, time2, node_map21):
+    """
+    Returns the difference between the node times ``time1`` of ts1 and
+    ``time2`` of ts2 for the equivalent nodes in ``node_map21``, which
+    must be the same for all.
+    """
+    shared2 = node_map21.keys_array()
+    shared1 = node_map21.values_array()
+    if len(shared2) == 0:
+        raise ValueError("No shared nodes to graft along.")
+    # checking shift in time ago between ts1 and ts2
+    dt = time1[shared1] - time2[shared2]
+    if len(np.unique(dt)) > 1:
+        raise ValueError(
+            "Inconsistent time differences among the equivalent nodes.")
+    return int(dt[0])
+
+
+def validate_graft(ts1, ts2, node_map21):
+    """
+    Checks that ts2 can be grafted onto ts1 along the nodes in
+    ``node_map21`` (an IdMap or a dictionary), raising a ValueError if
+    not, and returns the time difference between the equivalent nodes of
+    ts1 and ts2. These must all have the same time difference, no node
+    new to ts1 can be the parent of a shared node, and new nodes can only
+    migrate between their populations and those of shared nodes. Only
+    the node, edge and migration columns are read, so ``ts1`` and ``ts2``
+    can also be TableCollections (or other objects with table-like
+    attributes holding column arrays), which are not copied.
+    """
+    tables1, tables2 = _tables(ts1), _tables(ts2)
+    node_map21 = _as_id_map(node_map21, tables2.nodes.num_rows)
+    dT, _ = _validate_graft(tables1, tables2, node_map21)
+    return dT
 
 
-def graft(ts1, ts2, node_map21):
+def _validate_graft(tables1, tables2, node_map21, prepared=None):
+    """
+    Does the checks of :func:`validate_graft` for the IdMap
+    ``node_map21``, and returns the time difference and the masks of the
+    edges and mutations of ts2 to be grafted (see :func:`_new_rows`).
+    These are taken from the :class:`PreparedBranch` ``prepared``, if
+    given, rather than worked out again.
+    """
+    nodes1, nodes2 = tables1.nodes, tables2.nodes
+    shared1 = node_map21.values_array()
+    if np.any((shared1 < 0) | (shared1 >= nodes1.num_rows)):
+        raise ValueError("Node map refers to nodes not in ts1.")
+    is_new = node_map21.array == tskit.NULL
+    if prepared is None:
+        dT = _time_difference(nodes1.time, nodes2.time, node_map21)
+        new_rows = _new_rows(tables2, is_new)
+    else:
+        dT = prepared.dT
+        new_rows = (prepared.new_edges, prepared.new_mutations)
+    migrations2 = tables2.migrations
+    if migrations2.num_rows > 0:
+        # the populations that new nodes can migrate between (with an
+        # extra slot for NULL)
+        population2 = nodes2.population
+        grafted = np.zeros(tables2.populations.num_rows + 1, dtype=bool)
+        grafted[population2[is_new]] = True
+        shared2 = node_map21.keys_array()
+        grafted[population2[shared2][
+            nodes1.population[shared1] != tskit.NULL]] = True
+        grafted[tskit.NULL] = False
+        new = is_new[migrations2.node]
+        if not (np.all(grafted[migrations2.source[new]])
+                and np.all(grafted[migrations2.dest[new]])):
+            raise ValueError(
+                "Cannot graft trees that are dependent after the split")
+    return dT, new_rows
+
+
+def _graft_rows(new_tables, tables2, node_map21, new_rows, base=None,
+                pop_map21=None, nodes1=None):
+    """
+    Appends to ``new_tables`` the nodes of ``tables2`` that are not in
+    ``node_map21`` along with their populations, individuals, edges,
+    sites, mutations (those in the masks ``new_rows``, see
+    :func:`_new_rows`) and migrations, and returns the IdMaps from the
+    nodes, populations and individuals of ``tables2`` to ``new_tables``.
+    The tables are left unsorted. New rows get IDs following those
+    already in ``new_tables``, or starting from the number of rows given
+    by table name in ``base``. Populations in the IdMap ``pop_map21``
+    are already in ``new_tables`` and are not added again.
+    ``nodes1`` is the node table of ts1 (by default, that of
+    ``new_tables``). ``tables2`` can be any object
+    with table-like attributes holding column arrays.
+    """
+    if base is None:
+        base = {name: getattr(new_tables, name).num_rows
+                for name in ["nodes", "populations", "individuals",
+                             "sites"]}
+    if nodes1 is None:
+        nodes1 = new_tables.nodes
+    nodes2 = tables2.nodes
+    # mapping nodes in ts2 to new nodes in the grafted tables:
+    # matched nodes keep their ts1 id and the unmatched nodes
+    # are appended (in order) to the ts1 node table
+    node_map = node_map21.array.copy()
+    is_new = node_map == tskit.NULL
+    new_nodes = np.flatnonzero(is_new)
+    node_map[new_nodes] = np.arange(
+        base["nodes"],
+        base["nodes"] + len(new_nodes), dtype=np.int32)
+    # adding the pops of the new nodes (in order of first appearance)
+    new_pops = nodes2.population[new_nodes]
+    new_pops = _first_seen(new_pops[new_pops != tskit.NULL])
+    # (one extra slot so that NULL populations map to NULL)
+    pop_map = np.full(tables2.populations.num_rows + 1, tskit.NULL,
+                      dtype=np.int32)
+    if pop_map21 is not None:
+        known = pop_map21.keys_array()
+        known = known[known < tables2.populations.num_rows]
+        pop_map[known] = pop_map21.array[known]
+        new_pops = new_pops[pop_map[new_pops] == tskit.NULL]
+    pop_map[new_pops] = np.arange(
+        base["populations"],
+        base["populations"] + len(new_pops), dtype=np.int32)
+    metadata, metadata_offset = _ragged_take(
+        tables2.populations.metadata,
+        tables2.populations.metadata_offset, new_pops)
+    new_tables.populations.append_columns(
+        metadata=metadata, metadata_offset=metadata_offset)
+    # adding each individual of the new nodes once, in order, with
+    # their parents mapped as well: the individuals of shared nodes map
+    # to those of their equivalents in ts1, and any others to NULL
+    inds = nodes2.individual[new_nodes]
+    new_inds = np.unique(inds[inds != tskit.NULL])
+    individuals2 = tables2.individuals
+    # (one extra slot so that NULL individuals map to NULL)
+    ind_map = np.full(individuals2.num_rows + 1, tskit.NULL, dtype=np.int32)
+    shared = node_map21.keys_array()
+    shared_inds = nodes2.individual[shared]
+    has_ind = shared_inds != tskit.NULL
+    ind_map[shared_inds[has_ind]] = nodes1.individual[
+        node_map21.array[shared[has_ind]]]
+    ind_map[new_inds] = np.arange(
+        base["individuals"],
+        base["individuals"] + len(new_inds), dtype=np.int32)
+    location, location_offset = _ragged_take(
+        individuals2.location, individuals2.location_offset, new_inds)
+    parents, parents_offset = _ragged_take(
+        individuals2.parents, individuals2.parents_offset, new_inds)
+    metadata, metadata_offset = _ragged_take(
+        individuals2.metadata, individuals2.metadata_offset, new_inds)
+    new_tables.individuals.append_columns(
+        flags=individuals2.flags[new_inds],
+        location=location, location_offset=location_offset,
+        parents=ind_map[parents], parents_offset=parents_offset,
+        metadata=metadata, metadata_offset=metadata_offset)
+    ind_map2new = IdMap(ind_map[:individuals2.num_rows])
+    # adding the new nodes
+    metadata, metadata_offset = _ragged_take(
+        nodes2.metadata, nodes2.metadata_offset, new_nodes)
+    new_tables.nodes.append_columns(
+        flags=nodes2.flags[new_nodes],
+        time=nodes2.time[new_nodes],
+        population=pop_map[nodes2.population[new_nodes]],
+        individual=ind_map[inds],
+        metadata=metadata, metadata_offset=metadata_offset)
+    # now we need to add the edges touching new nodes, and the mutations
+    # on new nodes
+    edges2 = tables2.edges
+    mutations2 = tables2.mutations
+    sites2 = tables2.sites
+    new_edges, new_mutations = new_rows
+    keep = np.flatnonzero(new_edges)
+    new_tables.edges.append_columns(
+        left=edges2.left[keep],
+        right=edges2.right[keep],
+        parent=node_map[edges2.parent[keep]],
+        child=node_map[edges2.child[keep]])
+    # grafting sites and muts: each grafted mutation gets its own
+    # site, which are deduplicated after sorting
+    keep = np.flatnonzero(new_mutations)
+    mut_sites = mutations2.site[keep]
+    site_ids = np.arange(
+        base["sites"],
+        base["sites"] + len(keep), dtype=np.int32)
+    metadata, metadata_offset = _ragged_take(
+        sites2.metadata, sites2.metadata_offset, mut_sites)
+    new_tables.sites.append_columns(
+        position=sites2.position[mut_sites],
+        ancestral_state=np.zeros(0, dtype=np.int8),
+        ancestral_state_offset=np.zeros(
+            len(keep) + 1, dtype=sites2.ancestral_state_offset.dtype),
+        metadata=metadata, metadata_offset=metadata_offset)
+    derived_state, derived_state_offset = _ragged_take(
+        mutations2.derived_state, mutations2.derived_state_offset, keep)
+    metadata, metadata_offset = _ragged_take(
+        mutations2.metadata, mutations2.metadata_offset, keep)
+    new_tables.mutations.append_columns(
+        site=site_ids,
+        node=node_map[mutations2.node[keep]],
+        derived_state=derived_state,
+        derived_state_offset=derived_state_offset,
+        parent=np.full(len(keep), tskit.NULL, dtype=np.int32),
+        time=np.full(len(keep), tskit.UNKNOWN_TIME),
+        metadata=metadata, metadata_offset=metadata_offset)
+    # grafting the migrations of new nodes (those of shared nodes are in
+    # ts1 already), between the populations grafted along with them and
+    # those of shared nodes, which are those of their equivalents in ts1
+    # (see validate_graft)
+    mig_pop_map = pop_map.copy()
+    shared = node_map21.keys_array()
+    shared_pops = nodes2.population[shared]
+    known = shared_pops != tskit.NULL
+    shared_pops, shared = shared_pops[known], shared[known]
+    unmapped = pop_map[shared_pops] == tskit.NULL
+    mig_pop_map[shared_pops[unmapped]] = nodes1.population[
+        node_map21.array[shared[unmapped]]]
+    migrations2 = tables2.migrations
+    keep = np.flatnonzero(is_new[migrations2.node])
+    metadata, metadata_offset = _ragged_take(
+        migrations2.metadata, migrations2.metadata_offset, keep)
+    new_tables.migrations.append_columns(
+        left=migrations2.left[keep], right=migrations2.right[keep],
+        node=node_map[migrations2.node[keep]],
+        source=mig_pop_map[migrations2.source[keep]],
+        dest=mig_pop_map[migrations2.dest[keep]],
+        time=migrations2.time[keep],
+        metadata=metadata, metadata_offset=metadata_offset)
+    node_map2new = IdMap(node_map)
+    pop_map2new = IdMap(pop_map[:tables2.populations.num_rows])
+    return node_map2new, pop_map2new, ind_map2new
+
+
+def _new_rows(tables2, is_new):
+    """
+    Returns boolean masks of the edges and mutations of ts2 that are
+    grafted, which are those on the nodes new to ts1 given by ``is_new``,
+    raising a ValueError if a new node is the parent of a shared node.
+    """
+    edges2 = tables2.edges
+    new_child = is_new[edges2.child]
+    if np.any(is_new[edges2.parent] & ~new_child):
+        raise ValueError("Cannot graft nodes above existing nodes.")
+    return new_child, is_new[tables2.mutations.node]
+
+
+def _finalise_graft(new_tables, index=True):
+    """
+    Sorts the grafted tables and deduplicates sites, then indexes them
+    and re-computes mutation parents, unless ``index`` is False (as for
+    tables that are simplified first).
+    """
+    new_tables.sort()
+    new_tables.deduplicate_sites()
+    if index:
+        new_tables.build_index()
+        new_tables.compute_mutation_parents()
+
+
+def graft(ts1, ts2, node_map21, check_shared="full", previous_maps=None,
+          profiler=None):
     """
     Returns a tree sequence obtained by grafting together the
     two tree sequences along the nodes in ``node_map21``,
-    which should be a dictionary mapping nodes in ts2 that are
-    equivalent to nodes in ts1.
+    which should be an IdMap (or a dictionary) mapping nodes in ts2
+    that are equivalent to nodes in ts1.
     More precisely, ts2 is grafted onto ts1.
     Populations of nodes new to ts1 are considered new in the
-    grafted tree sequence. Map is returned.
+    grafted tree sequence. The migrations of new nodes are grafted too,
+    and can only be between their populations and those of shared
+    nodes. The IdMaps from nodes, populations and
+    individuals of ts2 to the grafted tree sequence are returned.
     T1 and T2 are used to shift the time in the tree seqs.
     It is used in cases where the after split portion of
     are run for different number of generations in each of ts1
     and ts2. If this is not the case set T1=T2=0
+    ``check_shared`` sets how the shared history of ts1 and ts2 is
+    verified before grafting, either "full", "fast" or "off"
+    (see :func:`_check_shared_nodes`).
+    To extend an earlier graft with a continuation of its branch, pass
+    that graft's result as ts1, the continued branch as ts2, the maps it
+    returned as ``previous_maps`` and, as ``node_map21``, the map from
+    the nodes of ts2 to those of the branch grafted then (e.g. from
+    :func:`match_nodes` with T2=0). Only nodes new since the earlier
+    graft are then added, with their edges and mutations, and the
+    populations of ts2 that were grafted already are reused. Its shared
+    history with ts1 is then checked with the populations of ts2
+    renumbered to those of ts1 through the nodes they share, and without
+    the ancestral states of sites (which graft does not keep).
+
+    The phases of grafting are recorded by the :class:`Profiler`
+    ``profiler``, if given.
     """
-    # making sure the ts are tskit ts
-    ts1, ts2 = ts1.tables.tree_sequence(), ts2.tables.tree_sequence()
-    # checking shift in time ago between ts1 and ts2
-    dt = [ts1.node(node_map21[a]).time - ts2.node(a).time for a in node_map21]
-    if len(set(dt)) > 1:
-        raise ValueError(
-            "Inconsistent time differences among the equivalent nodes.")
-    dT = int(dt[0])
-    if dT > 0:
-        ts2 = add_time(ts2, dT)
-    elif dT < 0:
-        ts1 = add_time(ts1, abs(dT))
+    tsg, maps, _ = _graft(ts1, ts2, node_map21, check_shared,
+                          previous_maps, profiler)
+    return tsg, maps
+
+
+def graft_and_simplify(ts1, ts2, node_map21, samples1, samples2,
+                       check_shared="full", previous_maps=None,
+                       profiler=None):
+    """
+    Grafts ts2 onto ts1 as :func:`graft` does, and simplifies the
+    grafted tree sequence to the nodes ``samples1`` of ts1 and
+    ``samples2`` of ts2 (those of ts2 that are shared with ts1 count
+    once). The grafted tables are simplified in place, before they are
+    indexed and their mutation parents computed, rather than building
+    the full grafted tree sequence first. Populations are kept as they
+    are, and migrations dropped (as simplify does not support them).
+    Returns the simplified tree sequence, the IdMaps from the nodes,
+    populations and individuals of ts2 to it (as :func:`graft` does,
+    composed through the simplification), and the IdMap from the nodes
+    of ts1 to it.
+    """
+    return _graft(ts1, ts2, node_map21, check_shared, previous_maps,
+                  profiler, simplify_to=(samples1, samples2))
+
+
+def _graft(ts1, ts2, node_map21, check_shared, previous_maps, profiler,
+           simplify_to=None):
+    """
+    Grafts ts2 onto ts1, simplifying to the nodes of ts1 and ts2 in
+    ``simplify_to`` if given, and returns the grafted tree sequence, the
+    maps from ts2 and the IdMap from the nodes of ts1 (None if not
+    simplified).
+    """
+    # a single copy of the tables of each tree sequence, shifted in place
+    with _phase(profiler, "copy_tables", nodes=ts1.num_nodes + ts2.num_nodes,
+                edges=ts1.num_edges + ts2.num_edges):
+        new_tables = ts1.dump_tables()
+        tables2 = ts2.dump_tables()
+    # checking that ts2 can be grafted before doing any work on the tables
+    with _phase(profiler, "validate", nodes=ts1.num_nodes + ts2.num_nodes,
+                edges=ts2.num_edges, migrations=ts2.num_migrations):
+        node_map21 = _as_id_map(node_map21, tables2.nodes.num_rows)
+        pop_map21 = None
+        if previous_maps is not None:
+            node_map21, pop_map21 = _continued_maps(node_map21,
+                                                    previous_maps)
+        dT, new_rows = _validate_graft(new_tables, tables2, node_map21)
+    with _phase(profiler, "shift_time", nodes=ts1.num_nodes + ts2.num_nodes):
+        if dT > 0:
+            _shift_time(tables2, dT)
+        elif dT < 0:
+            _shift_time(new_tables, abs(dT))
     # checking the trees are the same below the nodes_map21
-    _check_shared_nodes(ts1, ts2, node_map21)
-    # the grafted tree will bbe based off of ts1
-    new_tables = ts1.tables
-    # mapping nodes in ts2 to new nodes in the grafted tables
-    node_map2new = {}
-    node_map2new.update(node_map21)
-    # mapping of individuals in ts2 to new
-    ind_map2new = {}
-    # adding the pops in ts2 to new
-    pop_map2new = {}
-    # need to loop throgh nodes in ts2, find the unmatched nodes
-    # and add them to the ts1 node table
-    for k, n in enumerate(ts2.nodes()):
-        if k not in node_map21:
-            if n.population not in pop_map2new:
-                pop = ts2.tables.populations[n.population]
-                pid = new_tables.populations.add_row(pop.metadata)
-                pop_map2new[n.population] = pid
-            # translating pop to new
-            n.population = pop_map2new[n.population]
-            # adding individual
-            if n.individual >= 0:
-                ind = ts2.individual(n.individual)
-                iid = new_tables.individuals.add_row(
-                    flags=ind.flags, location=ind.location,
-                    metadata=ind.metadata)
-                ind_map2new[n.individual] = iid
-                n.individual = iid
-            # addingn node
-            nid = new_tables.nodes.add_row(**{"time": n.time,
-                                              "population": n.population,
-                                              "individual": n.individual,
-                                              "metadata": n.metadata,
-                                              "flags": n.flags})
-            node_map2new[k] = nid
-    # creating a set with nodes that are new to ts1
-    new_nodes = set(node_map2new) - set(node_map21)
-    # now we need to add the edges
-    for i, e in enumerate(ts2.edges()):
-        if (e.parent in new_nodes) or (e.child in new_nodes):
-            if (e.parent in new_nodes) and (e.child not in new_nodes):
-                raise ValueError("Cannot graft nodes above existing nodes.")
-            # translating the node ids from ts2 to new
-            new_parent = node_map2new[e.parent]
-            new_child = node_map2new[e.child]
-            new_tables.edges.add_row(
-                left=e.left,
-                right=e.right,
-                parent=new_parent,
-                child=new_child)
-    # grafting sites and muts
-    new_muts = {}
-    for k, m in enumerate(ts2.mutations()):
-        if m.node in new_nodes:
-            # translating node id
-            new_node = node_map2new[m.node]
-            # add site
-            s = ts2.site(m.site)
-            sid = new_tables.sites.add_row(
-                position=s.position,
-                ancestral_state="",
-                metadata=s.metadata)
-            mid = new_tables.mutations.add_row(
-                site=sid,
-                node=new_node,
-                derived_state=m.derived_state,
-                parent=tskit.NULL,
-                metadata=m.metadata)
-            new_muts[k] = mid
-    # migration table
-    for i, g in enumerate(ts2.migrations()):
-        # only migrations before the split
-        if g.time < dT:
-            node = node_map2new[g.node]
-            if not (g.source in pop_map2new and g.dest in pop_map2new
-                    ):
-                raise ValueError(
-                    "Cannot graft trees that are dependent after the split")
-            source = pop_map2new[g.source]
-            dest = pop_map2new[g.dest]
-            new_tables.migrations.add_row(
-                left=g.left,
-                right=g.right,
-                node=node,
-                source=source,
-                dest=dest,
-                time=g.time,
-                metadata=g.metadata)
-    new_tables.migrations.clear()
-    # grafting provenance table
-    new_tables.provenances.add_row(get_graft_prov_record(ts2,
-                                                         node_map21))
+    with _phase(profiler, "check_shared", nodes=len(node_map21)):
+        _check_shared_nodes(new_tables, tables2, node_map21, check_shared,
+                            continued=previous_maps is not None)
+    # the grafted tree will be based off of ts1
+    with _phase(profiler, "graft_rows", nodes=ts2.num_nodes,
+                edges=ts2.num_edges, mutations=ts2.num_mutations):
+        maps = _graft_rows(new_tables, tables2, node_map21, new_rows,
+                           pop_map21=pop_map21)
+        if previous_maps is not None:
+            _continue_individual_map(maps[2], previous_maps[2], tables2,
+                                     node_map21, new_tables)
+        # grafting provenance table
+        new_tables.provenances.add_row(get_graft_prov_record(tables2,
+                                                             node_map21))
     # sorting, deduplicating sites, and re-computing mutation parents
-    new_tables.sort()
-    new_tables.deduplicate_sites()
+    with _phase(profiler, "sort", edges=new_tables.edges.num_rows,
+                sites=new_tables.sites.num_rows,
+                mutations=new_tables.mutations.num_rows):
+        _finalise_graft(new_tables, index=simplify_to is None)
+    node_map1 = None
+    if simplify_to is not None:
+        with _phase(profiler, "simplify", nodes=new_tables.nodes.num_rows,
+                    edges=new_tables.edges.num_rows):
+            maps, node_map1 = _simplify_grafted(new_tables, simplify_to,
+                                                maps, ts1.num_nodes)
+    with _phase(profiler, "tree_sequence", edges=new_tables.edges.num_rows):
+        tsg = new_tables.tree_sequence()
+    return tsg, maps, node_map1
+
+
+def _simplify_grafted(new_tables, simplify_to, maps, num_nodes1):
+    """
+    Simplifies the sorted (unindexed) grafted tables to the nodes of ts1
+    and ts2 in ``simplify_to``, indexing them and computing mutation
+    parents, and returns the ``maps`` from ts2 composed through the
+    simplification and the IdMap from the nodes of ts1.
+    """
+    node_map2new, pop_map2new, ind_map2new = maps
+    samples1, samples2 = simplify_to
+    samples = _first_seen(np.concatenate([
+        np.asarray(samples1, dtype=np.int32),
+        node_map2new.array[np.asarray(samples2, dtype=np.int32)]]))
+    individual = new_tables.nodes.individual
+    num_individuals = new_tables.individuals.num_rows
+    # (simplify does not support migrations)
+    new_tables.migrations.clear()
+    node_map = new_tables.simplify(samples, filter_populations=False)
+    # simplify keeps the individuals of the nodes kept, in order
+    kept = individual[node_map != tskit.NULL]
+    kept = np.unique(kept[kept != tskit.NULL])
+    ind_map = np.full(num_individuals, tskit.NULL, dtype=np.int32)
+    ind_map[kept] = np.arange(len(kept), dtype=np.int32)
     new_tables.build_index()
     new_tables.compute_mutation_parents()
-    return new_tables.tree_sequence(), (node_map2new, pop_map2new,
-                                        ind_map2new)
+    return ((IdMap(_remap(node_map2new.array, node_map)), pop_map2new,
+             IdMap(_remap(ind_map2new.array, ind_map))),
+            IdMap(node_map[:num_nodes1]))
+
+
+def _continued_maps(node_map2prev, previous_maps):
+    """
+    Returns the node and population IdMaps from a continued branch to
+    an earlier graft, given the IdMap ``node_map2prev`` from its nodes to
+    those of the branch grafted then and the maps that graft returned.
+    """
+    prev_node_map, prev_pop_map = [
+        _loose_id_map(id_map) for id_map in previous_maps[:2]]
+    keys = node_map2prev.keys_array()
+    node_map21 = IdMap(np.full(len(node_map2prev.array), tskit.NULL,
+                               dtype=np.int32))
+    node_map21.array[keys] = prev_node_map.array[node_map2prev.array[keys]]
+    return node_map21, prev_pop_map
+
+
+def _continue_individual_map(ind_map, prev_ind_map, tables2, node_map21,
+                             new_tables):
+    """
+    Maps, in the IdMap ``ind_map``, the individuals of the nodes of a
+    continued branch that were grafted already (according to the
+    earlier graft's ``prev_ind_map``) to those grafted individuals.
+    """
+    nodes = node_map21.keys_array()
+    inds2 = tables2.nodes.individual[nodes]
+    inds = new_tables.nodes.individual[node_map21.array[nodes]]
+    grafted = (inds2 != tskit.NULL) & np.isin(
+        inds, _loose_id_map(prev_ind_map).values_array())
+    ind_map.array[inds2[grafted]] = inds[grafted]
+
+
+def graft_many(ts1, branches, node_maps=None, check_shared="full"):
+    """
+    Returns the tree sequence obtained by grafting each of the tree
+    sequences in ``branches`` onto ts1, as chaining :func:`graft` would,
+    but appending all the new rows to a single copy of the ts1 tables
+    and sorting them once. ``node_maps`` lists, for each branch, the
+    map from its nodes to the equivalent nodes in ts1, or its
+    :class:`PreparedBranch` (from :func:`prepare_branches`), whose time
+    offset and grafted rows are then not worked out again; if not given,
+    these maps are found for SLiM tree sequences with
+    :func:`find_split_time` and :func:`match_nodes` (indexing the
+    slim_ids of ts1 only once).
+    Also returns, for each branch, the tuple of node, population and
+    individual IdMaps to the grafted tree sequence.
+    """
+    if node_maps is None:
+        index1 = _slim_id_index(ts1)
+        node_maps = []
+        for ts2 in branches:
+            _, T2 = find_split_time(ts1, ts2)
+            tables2 = ts2.tables
+            node_maps.append(_match_slim_ids(
+                index1, get_slim_ids(tables2), tables2.nodes.time, T2))
+    if len(node_maps) != len(branches):
+        raise ValueError("Need one node map per branch.")
+    # a single copy of the tables of each tree sequence, shifted in place
+    new_tables = ts1.dump_tables()
+    branch_tables = [ts2.dump_tables() for ts2 in branches]
+    prepared = [node_map21 if isinstance(node_map21, PreparedBranch)
+                else None for node_map21 in node_maps]
+    node_maps = [
+        _as_id_map(node_map21 if p is None else p.node_map21,
+                   tables2.nodes.num_rows)
+        for tables2, node_map21, p in zip(branch_tables, node_maps, prepared)]
+    checks = [_validate_graft(new_tables, tables2, node_map21, p)
+              for tables2, node_map21, p in zip(branch_tables, node_maps,
+                                                prepared)]
+    dts = [dT for dT, _ in checks]
+    # ts1 is shifted once to be as old as the oldest branch
+    shift1 = max([0] + [-dT for dT in dts])
+    _shift_time(new_tables, shift1)
+    dts = [dT + shift1 for dT in dts]
+    # all branches are checked before ts1 gets any new rows
+    for tables2, node_map21, dT in zip(branch_tables, node_maps, dts):
+        _shift_time(tables2, dT)
+        _check_shared_nodes(new_tables, tables2, node_map21, check_shared)
+    maps = []
+    for tables2, node_map21, (_, new_rows) in zip(branch_tables, node_maps,
+                                                  checks):
+        maps.append(_graft_rows(new_tables, tables2, node_map21, new_rows))
+        new_tables.provenances.add_row(get_graft_prov_record(tables2,
+                                                             node_map21))
+    _finalise_graft(new_tables)
+    return new_tables.tree_sequence(), maps
+
+
+PreparedBranch = collections.namedtuple(
+    "PreparedBranch", ["node_map21", "dT", "new_edges", "new_mutations"])
+PreparedBranch.__doc__ = """
+The compact result of preparing a branch for grafting onto ts1: the
+IdMap from its nodes to ts1, the time offset ``dT`` to be added to it
+(negative if ts1 should be shifted instead), and boolean masks of its
+edges and mutations that are new to ts1.
+"""
+
+RootIndex = collections.namedtuple(
+    "RootIndex", ["slim_ids", "slim_id_order", "node_time",
+                  "provenance_timestamp", "provenance_timestamp_offset",
+                  "provenance_record", "provenance_record_offset",
+                  "is_slim_provenance", "slim_generations"])
+RootIndex.__doc__ = """
+What :func:`find_split_time` and :func:`match_nodes` need to know about
+a root tree sequence ts1: the slim_ids of its nodes and the order that
+sorts them, its node times, the columns of its provenance table with
+whether each row is a SLiM record, and the SLiM generations in them.
+"""
+
+
+def _root_index(ts1):
+    """
+    Returns the :class:`RootIndex` of the SLiM tree sequence ``ts1``.
+    """
+    slim_ids, slim_id_order = _slim_id_index(ts1)
+    provenances = _provenance_table(ts1)
+    record, offset = provenances.record, provenances.record_offset
+    generations = [
+        _slim_generation(bytes(record[offset[j]:offset[j + 1]]))
+        for j in range(provenances.num_rows)]
+    return RootIndex(
+        slim_ids, slim_id_order, _tables(ts1).nodes.time,
+        provenances.timestamp, provenances.timestamp_offset,
+        provenances.record, provenances.record_offset,
+        np.array([g is not None for g in generations], dtype=bool),
+        np.array([g for g in generations if g is not None],
+                 dtype=np.int64))
+
+
+def _root_split_times(root, ts2):
+    # find_split_time for the root tree sequence with RootIndex root
+    provenances1 = tskit.ProvenanceTable()
+    provenances1.set_columns(
+        timestamp=root.provenance_timestamp,
+        timestamp_offset=root.provenance_timestamp_offset,
+        record=root.provenance_record,
+        record_offset=root.provenance_record_offset)
+    provenances2 = _provenance_table(ts2)
+    num_shared_slim = np.count_nonzero(root.is_slim_provenance[
+        :_shared_provenances(provenances1, provenances2)])
+    generations = root.slim_generations
+    return _split_times(
+        generations[num_shared_slim - 1] if num_shared_slim > 0 else None,
+        generations[-1] if len(generations) > 0 else None,
+        _last_slim_generation(provenances2))
+
+
+class MatchCache:
+    """
+    An on-disk cache, in ``directory``, of the :class:`RootIndex` of
+    root tree sequence files, so that grafting more branches onto a root
+    skips loading and indexing it again. Entries are keyed by the path,
+    size and modification time of the file, and the least recently used
+    ones are evicted once the cache holds over ``max_bytes``. ``load`` is
+    the function used to load the tree sequences (by default,
+    ``tskit.load``).
+    """
+
+    def __init__(self, directory, max_bytes=2 ** 30, load=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.load = tskit.load if load is None else load
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, path1):
+        stat = os.stat(path1)
+        key = f"{os.path.realpath(path1)}\0{stat.st_size}\0{stat.st_mtime_ns}"
+        return os.path.join(
+            self.directory,
+            hashlib.sha256(key.encode()).hexdigest() + ".npz")
+
+    def root_index(self, path1):
+        """
+        Returns the :class:`RootIndex` of the tree sequence in the file
+        ``path1``, from the cache if it is there.
+        """
+        cache_path = self._path(path1)
+        try:
+            with np.load(cache_path) as data:
+                root = RootIndex(**{name: data[name]
+                                    for name in RootIndex._fields})
+            # marking it as recently used
+            os.utime(cache_path)
+            return root
+        except (OSError, KeyError, ValueError):
+            pass
+        root = _root_index(self.load(path1))
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            np.savez(f, **root._asdict())
+        os.replace(tmp_path, cache_path)
+        self._evict(keep=cache_path)
+        return root
+
+    def _evict(self, keep):
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".npz"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def find_split_time(self, path1, ts2):
+        """
+        Returns :func:`find_split_time` for the tree sequence in the
+        file ``path1`` and ts2.
+        """
+        return _root_split_times(self.root_index(path1), ts2)
+
+    def match_nodes(self, path1, ts2, T2=0):
+        """
+        Returns :func:`match_nodes` for the tree sequence in the file
+        ``path1`` and ts2.
+        """
+        root = self.root_index(path1)
+        tables2 = _tables(ts2)
+        return _match_slim_ids((root.slim_ids, root.slim_id_order),
+                               get_slim_ids(tables2), tables2.nodes.time, T2)
+
+
+# the RootIndex of the root tree sequence in each worker process
+_worker_root = {}
+
+
+def _init_branch_worker(root, load):
+    _worker_root["root"] = root
+    _worker_root["load"] = load
+
+
+def _prepare_branch(path2):
+    root = _worker_root["root"]
+    tables2 = _worker_root["load"](path2).tables
+    _, T2 = _root_split_times(root, tables2)
+    node_map21 = _match_slim_ids(
+        (root.slim_ids, root.slim_id_order), get_slim_ids(tables2),
+        tables2.nodes.time, T2)
+    dT = _time_difference(root.node_time, tables2.nodes.time, node_map21)
+    try:
+        new_edges, new_mutations = _new_rows(
+            tables2, node_map21.array == tskit.NULL)
+    except ValueError as e:
+        raise ValueError(f"{e} ({path2})") from e
+    return PreparedBranch(node_map21, dT, new_edges, new_mutations)
+
+
+def prepare_branches(path1, paths, processes=None, load=None, cache=None):
+    """
+    Loads the SLiM tree sequences in ``paths`` and, for each, finds
+    the split time from the root tree sequence in ``path1``, matches
+    its nodes to those of the root and works out the time offset and
+    the edges and mutations to be grafted. The root is loaded and
+    indexed once, and its :class:`RootIndex` sent to ``processes``
+    worker processes (by default, one per core), which prepare the
+    branches in parallel and only send back the resulting compact
+    arrays, as a list of :class:`PreparedBranch`, which can then be
+    passed to :func:`graft_many` as its ``node_maps``. ``load`` is the function used to
+    load the tree sequences (by default, ``tskit.load``). If a
+    :class:`MatchCache` is given as ``cache``, the root is indexed once,
+    on the first call, and not loaded again.
+    """
+    if load is None:
+        load = tskit.load
+    # (so that errors in loading or indexing the root are raised here)
+    if cache is None:
+        root = _root_index(load(path1))
+    else:
+        root = cache.root_index(path1)
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=processes, initializer=_init_branch_worker,
+            initargs=(root, load)) as executor:
+        return list(executor.map(_prepare_branch, paths))
+
+
+# kastore type codes are the indexes of their NumPy dtypes here
+_KAS_DTYPES = [np.dtype(t) for t in [
+    np.int8, np.uint8, np.int16, np.uint16, np.int32, np.uint32, np.int64,
+    np.uint64, np.float32, np.float64]]
+_KAS_MAGIC = b"\x89KAS\r\n\x1a\n"
+_KAS_HEADER_SIZE = 64
+_KAS_DESCRIPTOR_SIZE = 64
+# number of rows written at a time when streaming columns to a file
+_CHUNK_SIZE = 2 ** 20
+
+
+def _load_kastore(path):
+    """
+    Returns a dictionary mapping the keys of the kastore file at ``path``
+    to read-only arrays memory-mapped from the file.
+    """
+    data = np.memmap(path, dtype=np.uint8, mode="r")
+    header = bytes(data[:_KAS_HEADER_SIZE])
+    if header[:8] != _KAS_MAGIC:
+        raise ValueError(f"{path} is not a kastore file.")
+    num_items = struct.unpack("<I", header[12:16])[0]
+    arrays = {}
+    for j in range(num_items):
+        start = _KAS_HEADER_SIZE + j * _KAS_DESCRIPTOR_SIZE
+        descriptor = bytes(data[start:start + _KAS_DESCRIPTOR_SIZE])
+        key_start, key_len, array_start, array_len = struct.unpack(
+            "<QQQQ", descriptor[8:40])
+        key = bytes(data[key_start:key_start + key_len]).decode()
+        dtype = _KAS_DTYPES[descriptor[0]]
+        arrays[key] = data[
+            array_start:array_start + array_len * dtype.itemsize].view(dtype)
+    return arrays
+
+
+def _dump_kastore(path, columns):
+    """
+    Writes to ``path`` a kastore file with the arrays in ``columns``, a
+    dictionary mapping each key to a ``(dtype, length, chunks)`` tuple,
+    where ``chunks`` iterates over consecutive pieces of the array, so
+    that whole arrays need not be held in memory.
+    """
+    keys = sorted(columns)
+    encoded_keys = [key.encode() for key in keys]
+    offset = _KAS_HEADER_SIZE + len(keys) * _KAS_DESCRIPTOR_SIZE
+    key_starts = []
+    for key in encoded_keys:
+        key_starts.append(offset)
+        offset += len(key)
+    array_starts = []
+    for key in keys:
+        dtype, length, _ = columns[key]
+        # arrays are 8-byte aligned
+        offset += -offset % 8
+        array_starts.append(offset)
+        offset += length * np.dtype(dtype).itemsize
+    with open(path, "wb") as f:
+        header = bytearray(_KAS_HEADER_SIZE)
+        header[0:8] = _KAS_MAGIC
+        header[8:24] = struct.pack("<HHIQ", 1, 0, len(keys), offset)
+        f.write(header)
+        for key, encoded_key, key_start, array_start in zip(
+                keys, encoded_keys, key_starts, array_starts):
+            dtype, length, _ = columns[key]
+            descriptor = bytearray(_KAS_DESCRIPTOR_SIZE)
+            descriptor[0] = _KAS_DTYPES.index(np.dtype(dtype))
+            descriptor[8:40] = struct.pack(
+                "<QQQQ", key_start, len(encoded_key), array_start, length)
+            f.write(descriptor)
+        for encoded_key in encoded_keys:
+            f.write(encoded_key)
+        for key, array_start in zip(keys, array_starts):
+            dtype, length, chunks = columns[key]
+            f.write(bytes(array_start - f.tell()))
+            written = 0
+            for chunk in chunks:
+                chunk = np.ascontiguousarray(
+                    np.asarray(chunk).astype(dtype, copy=False))
+                f.write(memoryview(chunk).cast("B"))
+                written += len(chunk)
+            assert written == length
+
+
+class _StoreTable:
+    """
+    Read-only access to the columns of the ``name`` table in a kastore
+    mapping, with the attributes of a tskit table that :func:`_graft_rows`
+    and :func:`_shared_subgraph` use. Columns missing from files written
+    by older versions of tskit are filled with their defaults, and
+    ``time_shift`` is added to the time column.
+    """
+
+    # column giving the number of rows of each table
+    _length_column = {
+        "nodes": "time", "edges": "left", "sites": "position",
+        "mutations": "site", "individuals": "flags",
+        "migrations": "left", "populations": "metadata_offset",
+        "provenances": "timestamp_offset"}
+
+    def __init__(self, store, name, time_shift=0):
+        self.store = store
+        self.name = name
+        self.time_shift = time_shift
+
+    @property
+    def num_rows(self):
+        column = self._length_column[self.name]
+        length = len(self.store[f"{self.name}/{column}"])
+        return length - 1 if column.endswith("_offset") else length
+
+    def __getattr__(self, column):
+        key = f"{self.name}/{column}"
+        if column == "metadata_schema":
+            schema = bytes(self.store.get(key, b"")).decode()
+            return tskit.parse_metadata_schema(schema)
+        if key in self.store:
+            array = self.store[key]
+            if column == "time" and self.time_shift != 0:
+                # (unknown mutation times stay unknown)
+                known = ~tskit.is_unknown_time(array)
+                return np.where(known, array + self.time_shift, array)
+            # tskit takes ragged character columns as int8
+            return array.view(np.int8) if array.dtype == np.uint8 else array
+        if column.endswith("_offset"):
+            return np.zeros(self.num_rows + 1, dtype=np.uint32)
+        if column == "time":
+            return np.full(self.num_rows, tskit.UNKNOWN_TIME)
+        if column == "parents":
+            return np.zeros(0, dtype=np.int32)
+        if column in ("metadata", "location", "derived_state",
+                      "ancestral_state"):
+            return np.zeros(0, dtype=np.int8)
+        raise AttributeError(column)
+
+
+class _StoreTables:
+    """
+    Read-only, TableCollection-like access to a kastore mapping holding
+    a tree sequence, with ``time_shift`` added to node, migration and
+    mutation times, as :func:`_shift_time` does.
+    """
+
+    def __init__(self, store, time_shift=0):
+        self.store = store
+        self.time_shift = time_shift
+
+    def __getattr__(self, name):
+        if name not in _StoreTable._length_column:
+            raise AttributeError(name)
+        time_shift = self.time_shift if name in (
+            "nodes", "migrations", "mutations") else 0
+        return _StoreTable(self.store, name, time_shift)
+
+    @property
+    def sequence_length(self):
+        return float(self.store["sequence_length"][0])
+
+    @property
+    def metadata_schema(self):
+        schema = bytes(self.store.get("metadata_schema", b"")).decode()
+        return tskit.parse_metadata_schema(schema)
+
+    @property
+    def metadata(self):
+        return self.metadata_schema.decode_row(
+            bytes(self.store.get("metadata", b"")))
+
+    @property
+    def time_units(self):
+        return bytes(self.store.get("time_units", b"unknown")).decode()
+
+
+def _chunks(array):
+    """
+    Iterates over consecutive pieces of ``array``.
+    """
+    for start in range(0, len(array), _CHUNK_SIZE):
+        yield array[start:start + _CHUNK_SIZE]
+
+
+def _offset_dtype(total):
+    # 32 bit offsets are written whenever they fit, as tskit does
+    return np.uint32 if total <= np.iinfo(np.uint32).max else np.uint64
+
+
+def _take2(col1, col2, rows):
+    """
+    Returns the ``rows`` of the concatenation of ``col1`` and ``col2``,
+    without concatenating them.
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    out = np.empty(len(rows), dtype=np.result_type(col1.dtype, col2.dtype))
+    in1 = rows < len(col1)
+    out[in1] = col1[rows[in1]]
+    out[~in1] = col2[rows[~in1] - len(col1)]
+    return out
+
+
+def _appended_columns(name, table1, table2, columns, template):
+    """
+    Adds to ``columns`` (as used by :func:`_dump_kastore`) the columns of
+    the ``name`` table made of the rows of ``table1`` (a kastore mapping's
+    table) followed by those of ``table2``.
+    """
+    for key in template:
+        prefix, _, column = key.partition("/")
+        if prefix != name or column.endswith(
+                "_offset") or column == "metadata_schema":
+            continue
+        col1, col2 = getattr(table1, column), getattr(table2, column)
+        dtype = template[key].dtype
+        if key + "_offset" in template:
+            off1 = getattr(table1, column + "_offset")
+            off2 = np.asarray(getattr(table2, column + "_offset"),
+                              dtype=np.uint64)
+            total = int(off1[-1]) + int(off2[-1])
+            columns[key] = (dtype, total, itertools.chain(
+                _chunks(col1), [col2]))
+            columns[key + "_offset"] = (
+                _offset_dtype(total), table1.num_rows + table2.num_rows + 1,
+                itertools.chain(_chunks(off1), [off2[1:] + int(off1[-1])]))
+        else:
+            columns[key] = (dtype, len(col1) + len(col2), itertools.chain(
+                _chunks(col1), [col2]))
+
+
+def _permuted_columns(name, table1, table2, rows, columns, template,
+                      replace=None):
+    """
+    Adds to ``columns`` (as used by :func:`_dump_kastore`) the columns of
+    the ``name`` table made of the ``rows`` of the concatenation of
+    ``table1`` (a kastore mapping's table) and ``table2``. Columns with
+    values already worked out are given as arrays in ``replace``.
+    """
+    replace = {} if replace is None else replace
+    num_rows = len(rows)
+
+    def take(col1, col2):
+        for start in range(0, num_rows, _CHUNK_SIZE):
+            yield _take2(col1, col2, rows[start:start + _CHUNK_SIZE])
+
+    def take_ragged(data1, data2, offset):
+        for start in range(0, num_rows, _CHUNK_SIZE):
+            chunk = rows[start:start + _CHUNK_SIZE]
+            starts = offset[chunk]
+            lengths = offset[chunk + 1] - starts
+            index = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+            index += np.arange(len(index), dtype=np.int64)
+            yield _take2(data1, data2, index)
+
+    for key in template:
+        prefix, _, column = key.partition("/")
+        if prefix != name or column.endswith(
+                "_offset") or column == "metadata_schema":
+            continue
+        dtype = template[key].dtype
+        if column in replace:
+            columns[key] = (dtype, num_rows, [replace[column]])
+            continue
+        col1, col2 = getattr(table1, column), getattr(table2, column)
+        if key + "_offset" in template:
+            off1 = np.asarray(getattr(table1, column + "_offset"),
+                              dtype=np.int64)
+            off2 = np.asarray(getattr(table2, column + "_offset"),
+                              dtype=np.int64)
+            # offsets into the concatenated data of both tables
+            offset = np.concatenate([off1, off2[1:] + off1[-1]])
+            lengths = np.diff(offset)[rows]
+            new_offset = np.zeros(num_rows + 1, dtype=np.int64)
+            np.cumsum(lengths, out=new_offset[1:])
+            total = int(new_offset[-1])
+            columns[key] = (dtype, total, take_ragged(col1, col2, offset))
+            columns[key + "_offset"] = (
+                _offset_dtype(total), num_rows + 1, [new_offset])
+        else:
+            columns[key] = (dtype, num_rows, take(col1, col2))
+
+
+def _tskit_template(tables):
+    """
+    Returns the arrays that tskit writes for an empty tree sequence with
+    the top-level data of ``tables``, which fix the keys, types and format
+    version of the output file.
+    """
+    template = tskit.TableCollection(tables.sequence_length)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "template.trees")
+        template.dump(path)
+        return {key: np.array(value)
+                for key, value in _load_kastore(path).items()}
+
+
+def graft_to_file(path1, path2, out_path, node_map21, check_shared="fast",
+                  store_node_map=False):
+    """
+    Writes to ``out_path`` the tree sequence that :func:`graft` would
+    return for the tree sequences in the files ``path1`` and ``path2``,
+    and returns the same IdMaps, without loading either tree sequence
+    in full. The columns of both files are memory-mapped, only the rows
+    of ts2 that are grafted are copied into memory, and the output is
+    written column by column in chunks, sorting the edges, sites and
+    mutations through index arrays rather than table copies. Mutation
+    parents are computed only at sites that receive grafted mutations;
+    elsewhere those of ts1 (which must be valid) are kept. The shared
+    history is checked in "fast" mode by default, as "full" mode needs
+    to load both tree sequences. If ``store_node_map`` is True,
+    ``node_map21`` is also stored in full as an array of the output file
+    (which tskit ignores), for :func:`get_graft_node_map`.
+    """
+    if check_shared not in ("full", "fast", "off"):
+        raise ValueError(f"Unknown shared nodes check mode: {check_shared}")
+    store1 = _load_kastore(path1)
+    store2 = _load_kastore(path2)
+    tables1 = _StoreTables(store1)
+    tables2 = _StoreTables(store2)
+    node_map21 = _as_id_map(node_map21, tables2.nodes.num_rows)
+    dT, new_rows = _validate_graft(tables1, tables2, node_map21)
+    shift1 = max(0, -dT)
+    tables1 = _StoreTables(store1, shift1)
+    tables2 = _StoreTables(store2, max(0, dT))
+    # checking the trees are the same below the nodes_map21
+    if check_shared == "full":
+        full_tables1 = tskit.TableCollection.load(path1)
+        full_tables2 = tskit.TableCollection.load(path2)
+        _shift_time(full_tables1, shift1)
+        _shift_time(full_tables2, max(0, dT))
+        _check_shared_nodes(full_tables1, full_tables2, node_map21, "full")
+    else:
+        _check_shared_nodes(tables1, tables2, node_map21, check_shared)
+    # the rows of ts2 to be grafted, with IDs following those of ts1
+    delta = tskit.TableCollection(tables1.sequence_length)
+    base = {name: getattr(tables1, name).num_rows
+            for name in ["nodes", "populations", "individuals", "sites"]}
+    maps = _graft_rows(delta, tables2, node_map21, new_rows, base,
+                       nodes1=tables1.nodes)
+    provenances2 = tables2.provenances
+    records = bytes(provenances2.record).decode()
+    offset = provenances2.record_offset
+    ts2_prov_records = [records[offset[j]:offset[j + 1]]
+                        for j in range(provenances2.num_rows)]
+    node_map_key = None
+    if store_node_map:
+        node_map_key = f"graft/node_map21/{tables1.provenances.num_rows}"
+    delta.provenances.add_row(_graft_prov_record(
+        ts2_prov_records, node_map21, node_map_key))
+    template = _tskit_template(tables1)
+    columns = {}
+    for name in ["nodes", "populations", "individuals", "provenances"]:
+        _appended_columns(name, getattr(tables1, name),
+                          getattr(delta, name), columns, template)
+    # migrations, sorted as tskit does by (time, source, dest, left, node)
+    migrations1, new_migrations = tables1.migrations, delta.migrations
+    mig_rows = np.lexsort([
+        np.concatenate([getattr(migrations1, name),
+                        getattr(new_migrations, name)])
+        for name in ["node", "left", "dest", "source", "time"]])
+    _permuted_columns("migrations", migrations1, new_migrations, mig_rows,
+                      columns, template)
+    # edges, sorted as tskit does by (parent time, parent, child, left)
+    edges1 = tables1.edges
+    node_time = np.concatenate([tables1.nodes.time, delta.nodes.time])
+    parent = np.concatenate([edges1.parent, delta.edges.parent])
+    child = np.concatenate([edges1.child, delta.edges.child])
+    left = np.concatenate([edges1.left, delta.edges.left])
+    edge_rows = np.lexsort((left, child, parent, node_time[parent]))
+    parent, child, left = parent[edge_rows], child[edge_rows], left[
+        edge_rows]
+    right = _take2(edges1.right, delta.edges.right, edge_rows)
+    _permuted_columns("edges", edges1, delta.edges, edge_rows, columns,
+                      template)
+    parent_time = node_time[parent]
+    columns["indexes/edge_insertion_order"] = (
+        np.int32, len(edge_rows),
+        [np.lexsort((child, parent, parent_time, left))])
+    columns["indexes/edge_removal_order"] = (
+        np.int32, len(edge_rows),
+        [np.lexsort((-child, -parent, -parent_time, right))])
+    # sites, sorted by position and deduplicated keeping the first
+    sites1 = tables1.sites
+    position = np.concatenate([sites1.position, delta.sites.position])
+    site_order = np.argsort(position, kind="stable")
+    is_first = np.ones(len(site_order), dtype=bool)
+    is_first[1:] = position[site_order[1:]] != position[site_order[:-1]]
+    site_rank = np.empty(len(site_order), dtype=np.int64)
+    site_rank[site_order] = np.arange(len(site_order))
+    site_id = np.cumsum(is_first) - 1
+    site_rows = site_order[is_first]
+    position = position[site_rows]
+    _permuted_columns("sites", sites1, delta.sites, site_rows, columns,
+                      template)
+    # mutations, sorted by site, then by time (if known) and ID
+    mutations1 = tables1.mutations
+    mut_rank = site_rank[np.concatenate(
+        [mutations1.site, delta.mutations.site])]
+    mut_time = np.concatenate([mutations1.time, delta.mutations.time])
+    unknown = tskit.is_unknown_time(mut_time)
+    all_known = np.bincount(mut_rank, weights=unknown,
+                            minlength=len(site_order)) == 0
+    time_key = np.where(all_known[mut_rank], -np.nan_to_num(mut_time), 0)
+    mut_rows = np.lexsort((time_key, mut_rank))
+    mut_site = site_id[mut_rank[mut_rows]].astype(np.int32)
+    mut_id = np.empty(len(mut_rows), dtype=np.int32)
+    mut_id[mut_rows] = np.arange(len(mut_rows), dtype=np.int32)
+    num_mutations1 = mutations1.num_rows
+    mut_parent = np.full(len(mut_rows), tskit.NULL, dtype=np.int32)
+    from1 = mut_rows < num_mutations1
+    mut_parent[from1] = _remap(mutations1.parent[mut_rows[from1]], mut_id)
+    # recomputing parents at sites that received grafted mutations
+    grafted_sites = np.unique(mut_site[~from1])
+    if len(grafted_sites) > 0:
+        grafted_position = position[grafted_sites]
+        j = np.searchsorted(grafted_position, left)
+        overlaps = (j < len(grafted_position)) & (grafted_position[
+            np.minimum(j, len(grafted_position) - 1)] < right)
+        at_site = np.flatnonzero(np.isin(mut_site, grafted_sites))
+        sub = tskit.TableCollection(tables1.sequence_length)
+        sub.nodes.set_columns(
+            flags=np.zeros(len(node_time), dtype=np.uint32), time=node_time)
+        sub.edges.set_columns(
+            left=left[overlaps], right=right[overlaps],
+            parent=parent[overlaps], child=child[overlaps])
+        sub.sites.set_columns(
+            position=grafted_position,
+            ancestral_state=np.zeros(0, dtype=np.int8),
+            ancestral_state_offset=np.zeros(len(grafted_sites) + 1,
+                                            dtype=np.uint32))
+        rows = mut_rows[at_site]
+        sub.mutations.set_columns(
+            site=np.searchsorted(grafted_sites,
+                                 mut_site[at_site]).astype(np.int32),
+            node=_take2(mutations1.node, delta.mutations.node, rows),
+            time=mut_time[rows],
+            derived_state=np.zeros(0, dtype=np.int8),
+            derived_state_offset=np.zeros(len(at_site) + 1,
+                                          dtype=np.uint32))
+        sub.build_index()
+        sub.compute_mutation_parents()
+        mut_parent[at_site] = _remap(sub.mutations.parent,
+                                     at_site.astype(np.int32))
+    _permuted_columns("mutations", mutations1, delta.mutations, mut_rows,
+                      columns, template,
+                      replace={"site": mut_site, "parent": mut_parent})
+    if store_node_map:
+        columns[node_map_key] = (np.int32, len(node_map21.array),
+                                 [node_map21.array])
+    # everything else comes from ts1, or from tskit for a new file
+    for key, value in template.items():
+        if key in columns:
+            continue
+        if key in store1 and key not in ("uuid", "format/name",
+                                         "format/version"):
+            value = store1[key]
+        columns[key] = (value.dtype, len(value), [value])
+    # and every other array of ts1 is kept as it is (such as its reference
+    # sequence, or the node maps stored by earlier grafts)
+    for key in store1:
+        if key not in columns:
+            value = store1[key]
+            columns[key] = (value.dtype, len(value), [value])
+    _dump_kastore(out_path, columns)
+    return maps
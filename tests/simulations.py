@@ -0,0 +1,91 @@
+"""
+Simulated split tree sequences, shared by the tests and the benchmarks.
+"""
+import json
+import struct
+
+import msprime
+import numpy as np
+import tskit
+
+
+def simulate_split(num_samples, num_branches, T=100, N=100,
+                   sequence_length=2e4, recombination_rate=1e-8,
+                   mutation_rate=1e-8, ploidy=2, model=None, seed=None):
+    """
+    Returns a tree sequence in which a root population splits into
+    ``num_branches`` populations ``T`` generations ago, with
+    ``num_samples`` individuals sampled from each. Its mutations have
+    unknown times, as grafted mutations do (which can't share a site
+    with mutations of known time).
+    """
+    demography = msprime.Demography()
+    for j in range(num_branches):
+        demography.add_population(name=f"branch{j}", initial_size=N)
+    demography.add_population(name="root", initial_size=N)
+    demography.add_population_split(
+        time=T, derived=[f"branch{j}" for j in range(num_branches)],
+        ancestral="root")
+    ts = msprime.sim_ancestry(
+        {f"branch{j}": num_samples for j in range(num_branches)},
+        demography=demography, ploidy=ploidy, model=model,
+        sequence_length=sequence_length,
+        recombination_rate=recombination_rate, random_seed=seed)
+    ts = msprime.sim_mutations(ts, rate=mutation_rate, random_seed=seed)
+    tables = ts.dump_tables()
+    tables.mutations.time = np.full(ts.num_mutations, tskit.UNKNOWN_TIME)
+    return tables.tree_sequence()
+
+
+def split_branches(ts, T, num_branches, filter_populations=True):
+    """
+    Returns the branches of ``ts``, each holding the nodes at least ``T``
+    generations old and the samples of one population, and the map from
+    the nodes of each to those of the others (which keep the same IDs).
+    """
+    shared_nodes = [n.id for n in ts.nodes() if n.time >= T]
+    branches = [
+        ts.simplify(shared_nodes + list(ts.samples(population=j)),
+                    filter_populations=filter_populations)
+        for j in range(num_branches)]
+    node_map = {i: i for i in range(len(shared_nodes))}
+    return branches, node_map
+
+
+def slim_provenance(generation):
+    return json.dumps({
+        "schema_version": "1.0.0",
+        "software": {"name": "SLiM", "version": "3.4"},
+        "parameters": {"command": [], "model_type": "WF"},
+        "slim": {"generation": generation}})
+
+
+def slim_like_branches(ts, T, num_branches, gens=100, schema=None,
+                       filter_populations=True):
+    """
+    Returns the branches of ``ts`` (see :func:`split_branches`) with
+    SLiM-like node metadata, binary records whose slim_id is the ID of
+    the node in ``ts`` (encoded with ``schema``, if given), and the
+    provenances of SLiM runs of ``gens`` generations followed by ``T``
+    generations in each branch, so that ``find_split_time`` and
+    ``match_nodes`` run on them as they would on SLiM output.
+    """
+    tables = ts.dump_tables()
+    metadata = [struct.pack("<qBB", j, 0, 0) for j in range(ts.num_nodes)]
+    if schema is not None:
+        tables.nodes.metadata_schema = schema
+        metadata = [schema.validate_and_encode_row(
+            {"slim_id": j, "is_null": False, "genome_type": 0})
+            for j in range(ts.num_nodes)]
+    tables.nodes.packset_metadata(metadata)
+    branches, node_map = split_branches(
+        tables.tree_sequence(), T, num_branches, filter_populations)
+    slim_branches = []
+    for j, branch in enumerate(branches):
+        tables = branch.dump_tables()
+        tables.provenances.clear()
+        tables.provenances.add_row(slim_provenance(gens), timestamp="root")
+        tables.provenances.add_row(slim_provenance(gens + T),
+                                   timestamp=f"branch{j}")
+        slim_branches.append(tables.tree_sequence())
+    return slim_branches, node_map
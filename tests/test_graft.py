@@ -1,8 +1,16 @@
+import json
 import os
+import struct
+import tempfile
 import unittest
 import msprime
+import numpy as np
 import pyslim
+import tskit
 from graft import *
+from graft import _check_shared_nodes
+from simulations import (simulate_split, slim_like_branches, slim_provenance,
+                         split_branches)
 
 
 def run_slim_script(slimfile, args=''):
@@ -71,6 +79,34 @@ def get_msprime_mig_example(T=100, t=10, N=100, n=10):
     return ts
 
 
+def simplify_with_migrations(ts, samples):
+    # simplify does not support migrations: these are kept for the nodes
+    # kept, as a stand-in for those of the simplified tree sequence
+    tables = ts.dump_tables()
+    tables.migrations.clear()
+    node_map = tables.simplify(samples, filter_populations=False)
+    migrations = ts.tables.migrations
+    keep = node_map[migrations.node] != tskit.NULL
+    tables.migrations.set_columns(
+        left=migrations.left[keep], right=migrations.right[keep],
+        node=node_map[migrations.node[keep]],
+        source=migrations.source[keep], dest=migrations.dest[keep],
+        time=migrations.time[keep])
+    return tables.tree_sequence()
+
+
+def get_msprime_mig_branches(T=30, t=10, N=100, n=4):
+    # branches with pops 0 and 2, and 1 and 3 of get_msprime_mig_example,
+    # with their migrations
+    ts = get_msprime_mig_example(T, t, N, n)
+    shared_nodes = [n.id for n in ts.nodes() if n.time >= T]
+    branches = [
+        simplify_with_migrations(ts, shared_nodes + [
+            u for pop in pops for u in ts.samples(population=pop)])
+        for pops in [(0, 2), (1, 3)]]
+    return branches, {i: i for i in range(len(shared_nodes))}
+
+
 def get_msprime_example(T=100, N=100, n=10):
     # we assume after the split the ts are completely independent
     M = [[0, 0], [0, 0]]
@@ -98,6 +134,57 @@ def get_msprime_example(T=100, N=100, n=10):
     return ts
 
 
+def assert_tables_equal_ignoring_provenance(ts_or_tables1, ts_or_tables2):
+    tables1, tables2 = [
+        x.tables if isinstance(x, tskit.TreeSequence) else x
+        for x in (ts_or_tables1, ts_or_tables2)]
+    tables1.assert_equals(tables2, ignore_provenance=True)
+
+
+def get_msprime_branches(T=100, N=100, n=10, num_branches=3):
+    ts = simulate_split(n, num_branches, T, N, ploidy=1)
+    return split_branches(ts, T, num_branches)
+
+
+def get_dtwf_branches(T=100, N=100, n=10, mutation_rate=1e-7):
+    # discrete generations, so that node times stay integers when shifted
+    ts = simulate_split(n, 2, T, N, mutation_rate=mutation_rate,
+                        model="dtwf")
+    return split_branches(ts, T, 2, filter_populations=False)
+
+
+def continue_branch(ts, num_children=6, dt=5):
+    # a continuation of a branch by dt generations, in which random
+    # pairs of its samples have recombinant children with a new mutation
+    tables = add_time(ts, dt).dump_tables()
+    L = ts.sequence_length
+    samples = ts.samples()
+    for j in range(num_children):
+        a, b = samples[j % len(samples)], samples[(j + 1) % len(samples)]
+        child = tables.nodes.add_row(flags=tskit.NODE_IS_SAMPLE, time=0,
+                                     population=ts.node(a).population)
+        tables.edges.add_row(0, L / 2, a, child)
+        tables.edges.add_row(L / 2, L, b, child)
+        # (off the integer positions of msprime's mutations)
+        site = tables.sites.add_row(L * (j + 0.5) / num_children + 0.5,
+                                    "0")
+        tables.mutations.add_row(site, child, "1")
+    tables.sort()
+    return tables.tree_sequence()
+
+
+def get_slim_like_branches(T=100, N=100, n=10, num_branches=2, gens=100,
+                           schema=None):
+    ts = simulate_split(n, num_branches, T, N, ploidy=1)
+    branches, _ = slim_like_branches(ts, T, num_branches, gens, schema)
+    return branches
+
+
+def get_slim_like_example(T=100, N=100, n=10, schema=None):
+    ts1, ts2 = get_slim_like_branches(T, N, n, schema=schema)
+    return ts1, ts2
+
+
 def node_asdict(node):
     return {
         "time": node.time,
@@ -127,6 +214,60 @@ class TestFindSplitTime(unittest.TestCase):
             self.assertEqual(S1, T1)
             self.assertEqual(S2, T2)
 
+    def test_slim_like_example(self):
+        T = 50
+        ts1, ts2 = get_slim_like_example(T=T, n=4)
+        self.assertEqual(find_split_time(ts1, ts2), (T, T))
+
+    def test_provenance_chains(self):
+        # chains of SLiM and other records that diverge after a record
+        # of the same length, of a different length, or in a timestamp
+        other = json.dumps({"software": {"name": "other"}})
+        shared = [("t0", slim_provenance(1)), ("t1", other),
+                  ("t2", slim_provenance(5)), ("t3", other)]
+        for rows1, rows2, split_times in [
+                ([("t4", slim_provenance(21)), ("t5", other)],
+                 [("t4", slim_provenance(22))], (16, 17)),
+                ([("t4", other), ("t5", slim_provenance(10))],
+                 [("t4", other + " "), ("t5", slim_provenance(100))],
+                 (5, 95)),
+                ([("t4", slim_provenance(8))],
+                 [("t5", slim_provenance(8))], (3, 3)),
+                ([], [("t4", other), ("t5", slim_provenance(9))], (0, 4))]:
+            branches = []
+            for rows in [shared + rows1, shared + rows2]:
+                tables = tskit.TableCollection(1)
+                for timestamp, record in rows:
+                    tables.provenances.add_row(record, timestamp)
+                branches.append(tables)
+            self.assertEqual(find_split_time(*branches), split_times)
+            self.assertEqual(find_split_time(
+                *[tables.tree_sequence() for tables in branches]),
+                split_times)
+        tables = tskit.TableCollection(1)
+        tables.provenances.add_row(slim_provenance(1), "t1")
+        with self.assertRaises(ValueError):
+            find_split_time(branches[0], tables)
+
+    def test_slim4_provenance(self):
+        # SLiM 4 records the tick rather than the generation
+        def slim4_provenance(tick):
+            return json.dumps({
+                "schema_version": "1.0.0",
+                "software": {"name": "SLiM", "version": "4.0"},
+                "parameters": {"command": [], "model_type": "WF"},
+                "slim": {"tick": tick, "cycle": tick}})
+
+        shared = [("t0", slim4_provenance(10))]
+        branches = []
+        for rows in [shared + [("t1", slim4_provenance(25))],
+                     shared + [("t2", slim4_provenance(40))]]:
+            tables = tskit.TableCollection(1)
+            for timestamp, record in rows:
+                tables.provenances.add_row(record, timestamp)
+            branches.append(tables)
+        self.assertEqual(find_split_time(*branches), (15, 30))
+
 
 class TestMatchNodes(unittest.TestCase):
 
@@ -162,6 +303,216 @@ class TestMatchNodes(unittest.TestCase):
             self.verify_simplification_nodes(ts1, ts2)
 
 
+class TestAddTime(unittest.TestCase):
+
+    def test_msprime_example(self):
+        ts = msprime.sim_ancestry(5, population_size=100,
+                                  sequence_length=1e4, random_seed=3)
+        ts = msprime.sim_mutations(ts, rate=1e-6, random_seed=3)
+        self.assertGreater(ts.num_mutations, 0)
+        tss = add_time(ts, 10)
+        tables, tabless = ts.tables, tss.tables
+        self.assertTrue(np.all(
+            tabless.nodes.time == tables.nodes.time + 10))
+        self.assertTrue(np.all(
+            tabless.mutations.time == tables.mutations.time + 10))
+        tabless.nodes.time = tables.nodes.time
+        tabless.mutations.time = tables.mutations.time
+        self.assertEqual(tables, tabless)
+
+
+class TestIdMap(unittest.TestCase):
+
+    def test_dict_view(self):
+        d = {0: 3, 2: 5, 4: 0}
+        m = IdMap.from_dict(d, 6)
+        self.assertEqual(m, d)
+        self.assertEqual(len(m), 3)
+        self.assertEqual(list(m.keys()), [0, 2, 4])
+        self.assertEqual(list(m.values()), [3, 5, 0])
+        self.assertTrue(2 in m)
+        self.assertFalse(1 in m)
+        self.assertFalse(6 in m)
+        self.assertRaises(KeyError, m.__getitem__, 1)
+        self.assertEqual(m.get(1), None)
+        self.assertEqual(list(m.array), [3, -1, 5, -1, 0, -1])
+
+    def test_copy_and_update(self):
+        m = IdMap.from_dict({0: 3, 2: 5}, 3)
+        mc = m.copy()
+        mc[1] = 7
+        del mc[0]
+        self.assertEqual(mc, {1: 7, 2: 5})
+        self.assertEqual(m, {0: 3, 2: 5})
+        self.assertRaises(KeyError, mc.__setitem__, 3, 0)
+
+    def test_bad_keys(self):
+        self.assertRaises(ValueError, IdMap.from_dict, {3: 0}, 2)
+        self.assertRaises(ValueError, IdMap.from_dict, {-1: 0}, 2)
+
+    def test_ranges(self):
+        m = IdMap.from_dict({0: 5, 1: 6, 2: 7, 4: 1, 5: 0, 7: 2}, 9)
+        self.assertEqual(m.ranges().tolist(),
+                         [[0, 5, 3], [4, 1, 1], [5, 0, 1], [7, 2, 1]])
+        self.assertEqual(IdMap.from_ranges(m.ranges(), 9), m)
+        self.assertEqual(len(IdMap(np.full(3, -1)).ranges()), 0)
+
+    def test_dump_and_load(self):
+        m = IdMap.from_dict({0: 3, 2: 5}, 4)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "node_map.npy")
+            m.dump(path)
+            ml = IdMap.load(path)
+        self.assertEqual(list(ml.array), list(m.array))
+        self.assertEqual(ml.digest(), m.digest())
+        self.assertNotEqual(IdMap.from_dict({0: 3}, 4).digest(), m.digest())
+
+
+class TestSlimIds(unittest.TestCase):
+
+    def verify_slim_ids(self, ts):
+        slim_ids = get_slim_ids(ts)
+        self.assertEqual(len(slim_ids), ts.num_nodes)
+        for n, slim_id in zip(ts.nodes(), slim_ids):
+            md = n.metadata
+            if isinstance(md, bytes):
+                md = {"slim_id": struct.unpack("<qBB", md)[0]}
+            self.assertEqual(md["slim_id"], slim_id)
+
+    def test_raw_metadata(self):
+        ts1, ts2 = get_slim_like_example(n=4)
+        self.verify_slim_ids(ts1)
+        self.verify_slim_ids(ts2)
+
+    def test_struct_schema(self):
+        schema = tskit.MetadataSchema({
+            "codec": "struct",
+            "type": "object",
+            "properties": {
+                "slim_id": {"type": "integer", "binaryFormat": "q",
+                            "index": 0},
+                "is_null": {"type": "boolean", "binaryFormat": "?",
+                            "index": 1},
+                "genome_type": {"type": "integer", "binaryFormat": "B",
+                                "index": 2}}})
+        ts1, ts2 = get_slim_like_example(n=4, schema=schema)
+        self.verify_slim_ids(ts1)
+
+    def test_json_schema_fallback(self):
+        ts1, ts2 = get_slim_like_example(
+            n=4, schema=tskit.MetadataSchema.permissive_json())
+        self.verify_slim_ids(ts1)
+
+    def test_match_nodes(self):
+        T = 100
+        ts1, ts2 = get_slim_like_example(T=T, n=4)
+        node_map21 = match_nodes(ts1, ts2, T)
+        num_shared = sum(n.time >= T for n in ts2.nodes())
+        self.assertEqual(node_map21, {j: j for j in range(num_shared)})
+
+
+class TestPrepareBranches(unittest.TestCase):
+
+    def test_slim_like_example(self):
+        T = 100
+        branches = get_slim_like_branches(T=T, n=4, num_branches=4)
+        ts1 = branches[0]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            paths = []
+            for j, ts in enumerate(branches):
+                paths.append(os.path.join(tmpdir, f"branch{j}.trees"))
+                ts.dump(paths[-1])
+            prepared = prepare_branches(paths[0], paths[1:], processes=2)
+            # errors in loading the root are raised as they are
+            with self.assertRaises(FileNotFoundError):
+                prepare_branches(os.path.join(tmpdir, "missing.trees"),
+                                 paths[1:], processes=2)
+            cache = MatchCache(os.path.join(tmpdir, "cache"))
+            prepared_cached = prepare_branches(
+                paths[0], paths[1:], processes=2,
+                cache=cache)
+        self.assertEqual(len(prepared), len(branches) - 1)
+        for ts2, p in zip(branches[1:], prepared):
+            self.assertEqual(p.node_map21, match_nodes(ts1, ts2, T))
+            self.assertEqual(p.dT, 0)
+            new_nodes = [n not in p.node_map21 for n in range(ts2.num_nodes)]
+            self.assertEqual(list(p.new_edges),
+                             [new_nodes[e.child] for e in ts2.edges()])
+            self.assertEqual(list(p.new_mutations),
+                             [new_nodes[m.node] for m in ts2.mutations()])
+        tsg, maps = graft_many(ts1, branches[1:], prepared)
+        self.assertEqual(maps, graft_many(
+            ts1, branches[1:], [p.node_map21 for p in prepared])[1])
+        for p, pc in zip(prepared, prepared_cached):
+            self.assertEqual(p.node_map21, pc.node_map21)
+            self.assertEqual(p.dT, pc.dT)
+        tsm, _ = graft_many(ts1, branches[1:])
+        assert_tables_equal_ignoring_provenance(tsg, tsm)
+
+
+class TestMatchPrefix(unittest.TestCase):
+
+    def permute_nodes(self, ts, start):
+        # the same tree sequence, with the nodes from start on reversed
+        order = np.concatenate([np.arange(start),
+                                np.arange(ts.num_nodes - 1, start - 1, -1)])
+        tables = ts.dump_tables()
+        tables.subset(order, reorder_populations=False)
+        tables.sort()
+        return tables.tree_sequence()
+
+    def test_msprime_example(self):
+        T = 100
+        (ts1, ts2), node_map = get_dtwf_branches(T=T)
+        self.assertEqual(match_prefix(ts1, ts2, T), node_map)
+        self.assertEqual(match_prefix(ts1, add_time(ts2, 3), T + 3),
+                         node_map)
+        self.assertEqual(match_prefix(ts1, ts2, T, fallback=False),
+                         node_map)
+        # post-split nodes without metadata can look the same
+        self.assertRaises(ValueError, match_prefix, ts1, ts2)
+        # the nodes after the prefix have no slim_ids to match them by
+        ts2p = self.permute_nodes(ts2, 0)
+        self.assertRaises(ValueError, match_prefix, ts1, ts2p, T)
+        self.assertEqual(match_prefix(ts1, ts2p, T, fallback=False), {})
+
+    def test_slim_like_example(self):
+        T = 100
+        ts1, ts2 = get_slim_like_branches(T=T)
+        self.assertEqual(match_prefix(ts1, ts2, T),
+                         match_nodes(ts1, ts2, T))
+        for start in [0, 10, ts2.num_nodes // 2]:
+            ts2p = self.permute_nodes(ts2, start)
+            self.assertEqual(match_prefix(ts1, ts2p, T),
+                             match_nodes(ts1, ts2p, T))
+
+
+class TestMatchCache(unittest.TestCase):
+
+    def test_slim_like_example(self):
+        T = 100
+        branches = get_slim_like_branches(T=T, n=4, num_branches=3)
+        ts1, ts2 = branches[:2]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path1 = os.path.join(tmpdir, "branch0.trees")
+            ts1.dump(path1)
+            cache = MatchCache(os.path.join(tmpdir, "cache"))
+            for _ in range(2):
+                self.assertEqual(cache.find_split_time(path1, ts2),
+                                 find_split_time(ts1, ts2))
+                self.assertEqual(cache.match_nodes(path1, ts2, T),
+                                 match_nodes(ts1, ts2, T))
+                # the root is not loaded again
+                cache.load = None
+            # only the most recently used entry fits
+            cache = MatchCache(cache.directory, max_bytes=1)
+            path2 = os.path.join(tmpdir, "branch1.trees")
+            ts2.dump(path2)
+            cache.root_index(path2)
+            self.assertEqual(os.listdir(cache.directory),
+                             [os.path.basename(cache._path(path2))])
+
+
 class TestGraft(unittest.TestCase):
 
     def verify_graft_simplification(self, ts, tsg, node_map):
@@ -268,6 +619,322 @@ class TestGraft(unittest.TestCase):
                 full_sample_map[n] = n
         self.verify_graft_simplification(ts2, tsg, node_map=full_sample_map)
 
+    def test_msprime_new_rows(self):
+        T = 100
+        (ts1, ts2), node_map21 = split_branches(
+            get_msprime_example(T, 50, 4), T, 2)
+        tsg, (node_map2new, pop_map2new, ind_map2new) = graft(
+            ts1, ts2, node_map21)
+        # every unmatched node in ts2 is appended after the ts1 nodes
+        new_nodes = [n for n in range(ts2.num_nodes) if n not in node_map21]
+        self.assertEqual(tsg.num_nodes, ts1.num_nodes + len(new_nodes))
+        self.assertEqual(
+            sorted(node_map2new[n] for n in new_nodes),
+            list(range(ts1.num_nodes, tsg.num_nodes)))
+        for n in new_nodes:
+            self.assertEqual(ts2.node(n).time,
+                             tsg.node(node_map2new[n]).time)
+        # and so is every edge and mutation above them
+        new_edges = [e for e in ts2.edges() if e.child not in node_map21]
+        self.assertEqual(tsg.num_edges, ts1.num_edges + len(new_edges))
+        new_muts = [m for m in ts2.mutations() if m.node not in node_map21]
+        self.assertEqual(tsg.num_mutations,
+                         ts1.num_mutations + len(new_muts))
+
+    def test_check_shared_modes(self):
+        T = 100
+        (ts1, ts2), node_map21 = split_branches(
+            get_msprime_example(T, 50, 4), T, 2)
+        tsg, _ = graft(ts1, ts2, node_map21)
+        for mode in ["fast", "off"]:
+            tsm, _ = graft(ts1, ts2, node_map21, check_shared=mode)
+            assert_tables_equal_ignoring_provenance(tsg, tsm)
+        # changing the time of a shared node breaks the shared history
+        tables2 = ts2.dump_tables()
+        time = tables2.nodes.time
+        time[len(node_map21) - 1] += 0.5
+        tables2.nodes.time = time
+        tables2.sort()
+        ts2 = tables2.tree_sequence()
+        for mode in ["full", "fast"]:
+            with self.assertRaises(ValueError):
+                _check_shared_nodes(ts1, ts2, node_map21, mode)
+        _check_shared_nodes(ts1, ts2, node_map21, "off")
+        self.assertRaises(ValueError, _check_shared_nodes, ts1, ts2,
+                          node_map21, "sometimes")
+        # and so does changing a mutation on a shared node
+        (ts1, ts2), node_map21 = get_dtwf_branches(mutation_rate=1e-6)
+        tables2 = ts2.dump_tables()
+        shared = np.flatnonzero(np.isin(tables2.mutations.node,
+                                        list(node_map21)))
+        self.assertGreater(len(shared), 0)
+        tables2.mutations[shared[0]] = tables2.mutations[shared[0]].replace(
+            derived_state="X")
+        ts2 = tables2.tree_sequence()
+        for mode in ["full", "fast"]:
+            with self.assertRaises(ValueError):
+                _check_shared_nodes(ts1, ts2, node_map21, mode)
+
+    def test_validate_graft(self):
+        T = 100
+        (ts1, ts2), node_map21 = split_branches(
+            get_msprime_example(T, 50, 4), T, 2)
+        self.assertEqual(validate_graft(ts1, ts2, node_map21), 0)
+        self.assertEqual(
+            validate_graft(ts1, add_time(ts2, 3), node_map21), -3)
+        self.assertEqual(validate_graft(ts1.dump_tables(),
+                                        ts2.dump_tables(), node_map21), 0)
+        # nodes mapped to nodes with different times, or not in ts1
+        bad_map = dict(node_map21)
+        j = next(j for j in node_map21
+                 if ts1.node(j).time != ts1.node(0).time)
+        bad_map[0], bad_map[j] = j, 0
+        self.assertRaises(ValueError, validate_graft, ts1, ts2, bad_map)
+        bad_map[0], bad_map[j] = 0, ts1.num_nodes
+        self.assertRaises(ValueError, validate_graft, ts1, ts2, bad_map)
+        # a shared node under a node that is not
+        edge = next(e for e in ts2.edges() if e.child in node_map21)
+        bad_map = dict(node_map21)
+        del bad_map[edge.parent]
+        with self.assertRaises(ValueError):
+            validate_graft(ts1, ts2, bad_map)
+        with self.assertRaises(ValueError):
+            graft(ts1, ts2, bad_map)
+
+    def test_graft_many(self):
+        branches, node_map = get_msprime_branches(n=4, num_branches=4)
+        tsc = branches[0]
+        for ts2 in branches[1:]:
+            tsc, _ = graft(tsc, ts2, node_map)
+        tsg, maps = graft_many(branches[0], branches[1:],
+                               [node_map] * (len(branches) - 1))
+        self.assertEqual(len(maps), len(branches) - 1)
+        self.assertEqual(tsc.num_provenances, tsg.num_provenances)
+        assert_tables_equal_ignoring_provenance(tsc, tsg)
+        for ts2, (node_map2new, pop_map2new, ind_map2new) in zip(
+                branches[1:], maps):
+            self.assertEqual(len(node_map2new), ts2.num_nodes)
+            for n in ts2.nodes():
+                self.assertEqual(n.time, tsg.node(node_map2new[n.id]).time)
+
+    def test_graft_continuation(self):
+        (ts1, ts2), node_map = get_dtwf_branches()
+        tsg, maps = graft(ts1, ts2, node_map)
+        ts2c = continue_branch(ts2)
+        # the nodes of ts2 keep their IDs in the continuation
+        node_map2c2 = {j: j for j in range(ts2.num_nodes)}
+        tsc, mapsc = graft(tsg, ts2c, node_map2c2, previous_maps=maps)
+        for mode in ["fast", "off"]:
+            self.assertEqual(graft(tsg, ts2c, node_map2c2, check_shared=mode,
+                                   previous_maps=maps)[1], mapsc)
+        tsf, mapsf = graft(ts1, ts2c, node_map)
+        self.assertEqual(mapsc, mapsf)
+        self.assertEqual(tsc.num_provenances, tsf.num_provenances + 1)
+        assert_tables_equal_ignoring_provenance(tsc, tsf)
+
+    def test_graft_to_file(self):
+        (ts1, ts2), node_map = get_dtwf_branches()
+        # top-level data (shared by the branches) that the grafted file
+        # keeps from ts1
+        branches = []
+        for ts in (ts1, ts2):
+            tables = ts.dump_tables()
+            tables.reference_sequence.data = "ACGT" * 10
+            tables.reference_sequence.url = "https://example.com/ref.fa"
+            tables.metadata_schema = tskit.MetadataSchema({"codec": "json"})
+            tables.metadata = {"name": "root"}
+            branches.append(tables.tree_sequence())
+        ts1, ts2 = branches
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path1 = os.path.join(tmpdir, "ts1.trees")
+            path2 = os.path.join(tmpdir, "ts2.trees")
+            out_path = os.path.join(tmpdir, "grafted.trees")
+            for ts1_, ts2_ in [(ts1, ts2), (add_time(ts1, 3), ts2),
+                               (ts1, add_time(ts2, 3))]:
+                ts1_.dump(path1)
+                ts2_.dump(path2)
+                tsg, maps = graft(ts1_, ts2_, node_map)
+                mapsf = graft_to_file(path1, path2, out_path, node_map)
+                self.assertEqual(maps, mapsf)
+                tsf = tskit.load(out_path)
+                self.assertTrue(tsf.has_reference_sequence())
+                self.assertEqual(tsg.num_provenances, tsf.num_provenances)
+                assert_tables_equal_ignoring_provenance(tsg, tsf)
+
+    def test_graft_migrations(self):
+        (ts1, ts2), node_map = get_msprime_mig_branches()
+        self.assertGreater(ts1.num_migrations, 0)
+        self.assertGreater(ts2.num_migrations, 0)
+        tsg, (node_map2new, pop_map2new, _) = graft(ts1, ts2, node_map)
+        # ts1's migrations and those of the new nodes of ts2 are kept,
+        # the latter in the populations they were grafted to (or, at the
+        # split, in those of ts1)
+        expected = [(m.left, m.right, m.node, m.source, m.dest, m.time)
+                    for m in ts1.migrations()]
+        pop_map = dict(pop_map2new.items())
+        pop_map[0] = 0
+        for m in ts2.migrations():
+            if m.node not in node_map:
+                expected.append((m.left, m.right, node_map2new[m.node],
+                                 pop_map[m.source], pop_map[m.dest], m.time))
+        grafted = [(m.left, m.right, m.node, m.source, m.dest, m.time)
+                   for m in tsg.migrations()]
+        self.assertEqual(sorted(grafted), sorted(expected))
+        tables = tsg.dump_tables()
+        sorted_tables = tables.copy()
+        sorted_tables.sort()
+        self.assertEqual(tables.migrations, sorted_tables.migrations)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path1 = os.path.join(tmpdir, "ts1.trees")
+            path2 = os.path.join(tmpdir, "ts2.trees")
+            out_path = os.path.join(tmpdir, "grafted.trees")
+            ts1.dump(path1)
+            ts2.dump(path2)
+            graft_to_file(path1, path2, out_path, node_map)
+            self.assertEqual(tables.migrations,
+                             tskit.load(out_path).tables.migrations)
+        # a new node migrating to a population of ts1 only
+        tables2 = ts2.dump_tables()
+        dest = tables2.migrations.dest
+        dest[~np.isin(tables2.migrations.node, list(node_map))] = 2
+        tables2.migrations.dest = dest
+        with self.assertRaises(ValueError):
+            graft(ts1, tables2.tree_sequence(), node_map)
+
+    def test_profiler(self):
+        ts1, ts2 = get_slim_like_branches()
+        phases = []
+        profiler = Profiler(callback=phases.append)
+        T1, T2 = find_split_time(ts1, ts2, profiler=profiler)
+        node_map = match_nodes(ts1, ts2, T2, profiler=profiler)
+        tsg, maps = graft(ts1, ts2, node_map, profiler=profiler)
+        self.assertEqual(phases, profiler.phases)
+        report = profiler.report()
+        self.assertEqual(
+            [phase["name"] for phase in report],
+            ["find_split_time", "index_slim_ids", "get_slim_ids",
+             "match_slim_ids", "copy_tables", "validate", "shift_time",
+             "check_shared", "graft_rows", "sort", "tree_sequence"])
+        for phase in report:
+            self.assertGreaterEqual(phase["seconds"], 0)
+            if phase["rss_delta"] is not None:
+                self.assertIsInstance(phase["rss_delta"], int)
+        self.assertEqual(report[-1]["rows"], {"edges": tsg.num_edges})
+        self.assertEqual(len(str(profiler).splitlines()), len(report))
+        # the same results without profiling
+        tsg_, maps_ = graft(ts1, ts2, match_nodes(ts1, ts2, T2))
+        self.assertEqual(maps, maps_)
+
+    def test_graft_and_simplify(self):
+        (ts1, ts2), node_map = get_dtwf_branches(mutation_rate=1e-6)
+        # the present-day samples, and a shared node
+        samples1 = [0] + list(ts1.samples(time=0))
+        samples2 = [0] + list(ts2.samples(time=0))
+        tsg, (node_map2new, pop_map2new, ind_map2new) = graft(
+            ts1, ts2, node_map)
+        # (shared nodes count once)
+        samples = list(dict.fromkeys(
+            samples1 + [node_map2new[n] for n in samples2]))
+        tables = tsg.dump_tables()
+        simplify_map = tables.simplify(samples, filter_populations=False)
+        tss, (node_map2s, pop_map2s, ind_map2s), node_map1s = (
+            graft_and_simplify(ts1, ts2, node_map, samples1, samples2))
+        self.assertEqual(tables.provenances.num_rows, tss.num_provenances)
+        assert_tables_equal_ignoring_provenance(tables, tss)
+        self.assertEqual(pop_map2s, pop_map2new)
+        self.assertEqual(list(node_map1s.array),
+                         list(simplify_map[:ts1.num_nodes]))
+        for n2 in range(ts2.num_nodes):
+            self.assertEqual(node_map2s.get(n2, tskit.NULL),
+                             simplify_map[node_map2new[n2]])
+            ind2 = ts2.node(n2).individual
+            if node_map2s.get(n2) is not None and ind2 in ind_map2new:
+                self.assertEqual(ind_map2s[ind2],
+                                 tss.node(node_map2s[n2]).individual)
+
+    def test_graft_individuals(self):
+        (ts1, ts2), node_map = get_dtwf_branches()
+        # giving each new individual of ts2 the one before it as parent
+        tables2 = ts2.dump_tables()
+        new_inds = np.unique([ts2.node(n).individual
+                              for n in range(ts2.num_nodes)
+                              if n not in node_map and
+                              ts2.node(n).individual != tskit.NULL])
+        parents = np.full(ts2.num_individuals + 1, tskit.NULL,
+                          dtype=np.int32)
+        parents[new_inds[1:]] = new_inds[:-1]
+        # and the first the individual of a shared node, which maps to that
+        # of its equivalent in ts1
+        tables1 = ts1.dump_tables()
+        shared2 = next(iter(node_map))
+        for tables, node in [(tables1, node_map[shared2]),
+                             (tables2, shared2)]:
+            individual = tables.nodes.individual
+            individual[node] = tables.individuals.add_row(
+                parents=[tskit.NULL])
+            tables.nodes.individual = individual
+        parents[new_inds[0]] = ts2.num_individuals
+        tables2.individuals.packset_parents([[p] for p in parents])
+        ts1 = tables1.tree_sequence()
+        ts2 = tables2.tree_sequence()
+        tsg, (node_map2new, _, ind_map2new) = graft(ts1, ts2, node_map)
+        # diploid individuals are grafted once, not once per genome
+        self.assertEqual(tsg.num_individuals,
+                         ts1.num_individuals + len(new_inds))
+        self.assertEqual(ind_map2new[ts2.num_individuals - 1],
+                         ts1.num_individuals - 1)
+        self.assertEqual(
+            list(tsg.individual(ind_map2new[new_inds[0]]).parents),
+            [ts1.num_individuals - 1])
+        for ind2, indg in ind_map2new.items():
+            self.assertEqual(
+                [node_map2new[n] for n in ts2.individual(ind2).nodes],
+                list(tsg.individual(indg).nodes))
+            parent = parents[ind2]
+            self.assertEqual(
+                list(tsg.individual(indg).parents),
+                [tskit.NULL if parent == tskit.NULL
+                 else ind_map2new[parent]])
+
+    def test_graft_prov_record(self):
+        (ts1, ts2), node_map = get_dtwf_branches()
+        tsg, _ = graft(ts1, ts2, node_map)
+        record = tsg.provenance(tsg.num_provenances - 1).record
+        parameters = json.loads(record)["parameters"]
+        self.assertEqual(parameters["ts2_provenances"]["num_records"],
+                         ts2.num_provenances)
+        self.assertEqual(get_graft_node_map(record), node_map)
+        # a map with many ranges is only summarised
+        rng = np.random.default_rng(1)
+        big_map = IdMap(rng.permutation(100000))
+        big_record = get_graft_prov_record(ts2, big_map)
+        self.assertLess(len(big_record), 2 * len(record))
+        self.assertRaises(ValueError, get_graft_node_map, big_record)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path1 = os.path.join(tmpdir, "ts1.trees")
+            path2 = os.path.join(tmpdir, "ts2.trees")
+            out_path = os.path.join(tmpdir, "grafted.trees")
+            ts1.dump(path1)
+            ts2.dump(path2)
+            graft_to_file(path1, path2, out_path, node_map,
+                          store_node_map=True)
+            tsf = tskit.load(out_path)
+            record = json.loads(
+                tsf.provenance(tsf.num_provenances - 1).record)
+            # without its ranges, the map is read from the file
+            del record["parameters"]["node_map21"]["ranges"]
+            self.assertEqual(
+                get_graft_node_map(json.dumps(record), out_path).array
+                .tolist(),
+                IdMap.from_dict(node_map, ts2.num_nodes).array.tolist())
+            # and is still there after grafting onto that file
+            out_path2 = os.path.join(tmpdir, "grafted2.trees")
+            graft_to_file(out_path, path2, out_path2, node_map)
+            self.assertEqual(
+                get_graft_node_map(json.dumps(record), out_path2).array
+                .tolist(),
+                IdMap.from_dict(node_map, ts2.num_nodes).array.tolist())
+
     def test_slim_nonwf_example(self):
         ts1, ts2 = get_slim_examples(
             10, 10, gens=100, N=100, recipe_path="tests/recipe_nonwf1.slim")